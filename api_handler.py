@@ -1,11 +1,43 @@
 # api_handler.py
 
-import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
 from config import Config
-from funcs import get_embedding_from_url
+from funcs import get_embedding_from_url, encode_upload_image
+from tracing import span
 
-def save_attendance_to_api(person_id, device_id, image_path, timestamp, score):
+upload_executor = ThreadPoolExecutor(max_workers=Config.UPLOAD_WORKERS, thread_name_prefix="image-upload")
+upload_slots = threading.BoundedSemaphore(Config.UPLOAD_MAX_PENDING)  # Queued plus running background uploads
+
+class ReportImage:
+    """The photo attached to a report, taken from the frame already decoded for recognition.
+
+    The source JPEG is sent unchanged in 'original' mode; otherwise the decoded frame (or the
+    face crop around bbox) is re-encoded in memory the first time a report needs it.
+    """
+
+    def __init__(self, name, jpeg_bytes, image=None, bbox=None):
+        self.name = name
+        self.jpeg_bytes = jpeg_bytes
+        self.image = image
+        self.bbox = bbox
+        self.encoded = None
+
+    def content(self):
+        if self.encoded is None:
+            if Config.UPLOAD_IMAGE_MODE == 'original' or self.image is None:
+                self.encoded = self.jpeg_bytes
+            else:
+                self.encoded = encode_upload_image(self.image, self.bbox)
+                Config.logger.debug("Re-encoded %s for upload: %s -> %s bytes", self.name, len(self.jpeg_bytes), len(self.encoded))
+        return self.encoded
+
+    def field(self):
+        """Return the multipart 'image' field."""
+        return (self.name, self.content(), 'image/jpeg')
+
+def save_attendance_to_api(person_id, device_id, timestamp, score, image):
     """Send attendance data to FastAPI API"""
     endpoint = "/attendance/create"  # Adjust as per actual API endpoint
     data = {
@@ -16,15 +48,47 @@ def save_attendance_to_api(person_id, device_id, image_path, timestamp, score):
     }
     try:
         headers = {'Authorization': f'Bearer {Config.API_TOKEN}'}
-        with open(image_path, 'rb') as img_file:
+        if Config.UPLOAD_ASYNC:
+            # Record the attendance right away; the photo follows in the background
+            response = send_report_with_response(endpoint, data=data, headers=headers)
+            attendance_id = response.json().get('data', {}).get('id') if response else None
+            if attendance_id:
+                if upload_slots.acquire(blocking=False):
+                    try:
+                        # Queue only the encoded JPEG, never the decoded frame
+                        upload_executor.submit(upload_attendance_image, attendance_id, image.field())
+                    except Exception:
+                        upload_slots.release()
+                        raise
+                else:
+                    Config.logger.warning(
+                        "Image upload backlog is full (%s pending); attendance %s is kept without its image.",
+                        Config.UPLOAD_MAX_PENDING, attendance_id
+                    )
+            elif response:
+                Config.logger.error("Attendance ID not found in the API response; image not uploaded.")
+        else:
             files = {
-                'image': (os.path.basename(image_path), img_file, 'image/jpeg')
+                'image': image.field()
             }
             response = send_report(endpoint, data=data, files=files, headers=headers)
-            if response:
-                Config.logger.info(f"Attendance sent for employee {person_id} with similarity {score}")
+        if response:
+            Config.logger.info("Attendance sent for employee %s with similarity %s", person_id, score)
     except Exception as e:
-        Config.logger.error(f"Error sending attendance to API: {e}")
+        Config.logger.error("Error sending attendance to API: %s", e)
+
+def upload_attendance_image(attendance_id, image_field):
+    """Attach the photo to an attendance record created without one."""
+    try:
+        headers = {'Authorization': f'Bearer {Config.API_TOKEN}'}
+        files = {
+            'image': image_field
+        }
+        send_report(Config.ATTENDANCE_IMAGE_ENDPOINT.format(attendance_id=attendance_id), files=files, headers=headers)
+    except Exception as e:
+        Config.logger.error("Error uploading image for attendance %s: %s", attendance_id, e)
+    finally:
+        upload_slots.release()
 
 def update_client_via_api(client_id, datetime_str, device_id):
     """Send client visit data to FastAPI API"""
@@ -37,11 +101,11 @@ def update_client_via_api(client_id, datetime_str, device_id):
         headers = {'Authorization': f'Bearer {Config.API_TOKEN}'}
         response = send_report_json(endpoint, data=data, headers=headers)
         if response:
-            Config.logger.info(f"Client {client_id} visit updated.")
+            Config.logger.info("Client %s visit updated.", client_id)
     except Exception as e:
-        Config.logger.error(f"Error updating client visit via API: {e}")
+        Config.logger.error("Error updating client visit via API: %s", e)
 
-def create_client_via_api(image_path, first_seen, last_seen, gender, age):
+def create_client_via_api(first_seen, last_seen, gender, age, image):
     """Create a new client via FastAPI API and return the new client ID"""
     endpoint = "/client/create"
     data = {
@@ -56,63 +120,81 @@ def create_client_via_api(image_path, first_seen, last_seen, gender, age):
     }
     try:
         headers = {'Authorization': f'Bearer {Config.API_TOKEN}'}
-        with open(image_path, 'rb') as img_file:
-            files = {
-                'image': (os.path.basename(image_path), img_file, 'image/jpeg')
-            }
-            response = send_report_with_response(endpoint, data=data, files=files, params=params, headers=headers)
-            if response and response.status_code == 200:
-                client_data = response.json()
-                new_client_id = client_data.get('data', {}).get('id')
-                if new_client_id:
-                    Config.logger.info(f"New client created with ID: {new_client_id}")
-                    return new_client_id
-                else:
-                    Config.logger.error("New client ID not found in the API response.")
-                    return None
+        files = {
+            'image': image.field()
+        }
+        response = send_report_with_response(endpoint, data=data, files=files, params=params, headers=headers)
+        if response and response.status_code == 200:
+            client_data = response.json()
+            new_client_id = client_data.get('data', {}).get('id')
+            if new_client_id:
+                Config.logger.info("New client created with ID: %s", new_client_id)
+                return new_client_id
             else:
-                Config.logger.error(f"Failed to create new client. Status Code: {response.status_code if response else 'No Response'}")
+                Config.logger.error("New client ID not found in the API response.")
                 return None
+        else:
+            Config.logger.error("Failed to create new client. Status Code: %s", response.status_code if response else 'No Response')
+            return None
     except Exception as e:
-        Config.logger.error(f"Error creating new client via API: {e}")
+        Config.logger.error("Error creating new client via API: %s", e)
         return None
 
+def merge_clients_via_api(canonical_id, duplicate_ids):
+    """Report that duplicate clients were merged into a canonical client. Returns True on success."""
+    data = {
+        'canonical_id': canonical_id,
+        'merged_ids': duplicate_ids
+    }
+    try:
+        headers = {'Authorization': f'Bearer {Config.API_TOKEN}'}
+        response = send_report_json(Config.CLIENT_MERGE_ENDPOINT, data=data, headers=headers)
+        if response:
+            Config.logger.info("Clients %s merged into client %s.", duplicate_ids, canonical_id)
+            return True
+    except Exception as e:
+        Config.logger.error("Error reporting client merge via API: %s", e)
+    return False
+
 def send_report(endpoint, data=None, files=None, headers=None):
     url = f"{Config.API_BASE_URL}{endpoint}"
     try:
-        response = requests.post(url, data=data, files=files, headers=headers)
+        with span('api_post', endpoint=endpoint):
+            response = requests.post(url, data=data, files=files, headers=headers)
         response.raise_for_status()
-        Config.logger.info(f"Successfully sent report to {endpoint}")
+        Config.logger.info("Successfully sent report to %s", endpoint)
         return response
     except requests.RequestException as e:
-        Config.logger.error(f"Failed to send report to {endpoint}: {e}")
+        Config.logger.error("Failed to send report to %s: %s", endpoint, e)
         return None
 
 def send_report_json(endpoint, data=None, headers=None):
     """Send JSON report to FastAPI API"""
     url = f"{Config.API_BASE_URL}{endpoint}"
     try:
-        response = requests.post(url, json=data, headers=headers)
+        with span('api_post', endpoint=endpoint):
+            response = requests.post(url, json=data, headers=headers)
         response.raise_for_status()
-        Config.logger.info(f"Successfully sent JSON report to {endpoint}")
+        Config.logger.info("Successfully sent JSON report to %s", endpoint)
         return response
     except requests.RequestException as e:
         # Attempt to log the response content for detailed error information
         try:
             error_content = response.json()
-            Config.logger.error(f"Failed to send JSON report to {endpoint}: {e}, Response: {error_content}")
+            Config.logger.error("Failed to send JSON report to %s: %s, Response: %s", endpoint, e, error_content)
         except Exception:
-            Config.logger.error(f"Failed to send JSON report to {endpoint}: {e}")
+            Config.logger.error("Failed to send JSON report to %s: %s", endpoint, e)
         return None
 
 def send_report_with_response(endpoint, data=None, files=None, params=None, headers=None):
     """Send report and return the response object"""
     url = f"{Config.API_BASE_URL}{endpoint}"
     try:
-        response = requests.post(url, data=data, files=files, params=params, headers=headers)
+        with span('api_post', endpoint=endpoint):
+            response = requests.post(url, data=data, files=files, params=params, headers=headers)
         response.raise_for_status()
-        Config.logger.info(f"Successfully sent report to {endpoint}")
+        Config.logger.info("Successfully sent report to %s", endpoint)
         return response
     except requests.RequestException as e:
-        Config.logger.error(f"Failed to send report to {endpoint}: {e}")
+        Config.logger.error("Failed to send report to %s: %s", endpoint, e)
         return None
\ No newline at end of file
@@ -0,0 +1,68 @@
+# client_compactor.py
+
+import time
+from config import Config
+from api_handler import merge_clients_via_api
+
+
+class ClientCompactor:
+    """Background job that merges clients whose embeddings belong to the same visitor.
+
+    Each run only range-searches clients that were not checked before, in small batches,
+    so the database lock is held for one batch at a time and live matching keeps going.
+    """
+
+    def __init__(self, db_manager):
+        self.db_manager = db_manager
+        self.checked_ids = set()
+
+    def run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                Config.logger.error(f"Error in client compaction: {e}")
+            time.sleep(Config.CLIENT_COMPACTION_INTERVAL_SECONDS)
+
+    def run_once(self):
+        client_ids = self.db_manager.get_client_ids()
+        # Forget clients that were merged or deleted since the last run
+        self.checked_ids &= set(client_ids)
+        pending = sorted(pid for pid in client_ids if pid not in self.checked_ids)
+        if not pending:
+            return 0
+
+        Config.logger.info(f"Client compaction: checking {len(pending)} new clients.")
+        merged_total = 0
+        batch_size = Config.CLIENT_COMPACTION_BATCH_SIZE
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            neighbours = self.db_manager.search_clients_range(batch, Config.CLIENT_MERGE_THRESHOLD)
+            for cluster in self.build_clusters(batch, neighbours):
+                canonical_id = min(cluster)
+                duplicate_ids = sorted(cluster - {canonical_id})
+                if not merge_clients_via_api(canonical_id, duplicate_ids):
+                    # Leave the cluster unchecked so the next run retries it
+                    self.checked_ids.difference_update(cluster)
+                    continue
+                self.db_manager.merge_clients(canonical_id, duplicate_ids)
+                self.checked_ids.difference_update(duplicate_ids)
+                merged_total += len(duplicate_ids)
+            time.sleep(Config.CLIENT_COMPACTION_PAUSE_SECONDS)
+
+        Config.logger.info(f"Client compaction finished: merged {merged_total} duplicate clients.")
+        return merged_total
+
+    def build_clusters(self, batch, neighbours):
+        """Group each client with its direct neighbours, so clusters never chain through weak links."""
+        clusters = []
+        assigned = set()
+        for person_id in batch:
+            self.checked_ids.add(person_id)
+            if person_id in assigned or person_id not in neighbours:
+                continue
+            cluster = {person_id} | {other_id for other_id, _ in neighbours[person_id] if other_id not in assigned}
+            if len(cluster) > 1:
+                clusters.append(cluster)
+                assigned |= cluster
+        return clusters
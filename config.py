@@ -1,13 +1,69 @@
 # config.py
 
 import os
+import atexit
+import queue
+import threading
+import time
 from dotenv import load_dotenv
 import logging
+import logging.handlers
 
 load_dotenv()
 
-def setup_logger(name, log_file, level=logging.INFO):
-    """Function to setup a logger with a given name and log file."""
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queue the record as is; the listener thread does all message formatting and I/O."""
+
+    def prepare(self, record):
+        return record
+
+
+class RateLimitFilter(logging.Filter):
+    """Drop repeats of the same WARNING message within a window and report how many were dropped.
+
+    Repeats are keyed on the template and the formatted text, so warnings sharing a template
+    but naming another gallery or person still pass. Errors always pass.
+    """
+
+    MAX_KEYS = 1000  # Distinct warnings remembered at most
+
+    def __init__(self, seconds):
+        super().__init__()
+        self.seconds = seconds
+        self.last_emitted = {}
+        self.suppressed = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if self.seconds <= 0 or record.levelno != logging.WARNING:
+            return True
+        # Warnings are rare, so formatting them here costs little
+        key = (record.msg, record.getMessage())
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last_emitted.get(key, -self.seconds) < self.seconds:
+                self.suppressed[key] = self.suppressed.get(key, 0) + 1
+                return False
+            if len(self.last_emitted) >= self.MAX_KEYS:
+                self.last_emitted = {k: t for k, t in self.last_emitted.items() if now - t < self.seconds}
+                if len(self.last_emitted) >= self.MAX_KEYS:
+                    # A flood of distinct warnings; let repeats through again rather than grow
+                    self.last_emitted = {}
+                self.suppressed = {k: n for k, n in self.suppressed.items() if k in self.last_emitted}
+            self.last_emitted[key] = now
+            suppressed = self.suppressed.pop(key, 0)
+        if suppressed:
+            record.msg = f"{record.msg} (suppressed {suppressed} similar messages)"
+        return True
+
+
+def setup_logger(name, log_file, level=logging.INFO, rate_limit_seconds=0):
+    """Function to setup a logger with a given name and log file.
+
+    Callers only put records on a queue; a listener thread formats them and writes
+    to the console and the log file, so slow disks or terminals never stall processing.
+    """
     logger = logging.getLogger(name)
     logger.setLevel(level)
 
@@ -23,9 +79,15 @@ def setup_logger(name, log_file, level=logging.INFO):
     c_handler.setFormatter(c_format)
     f_handler.setFormatter(f_format)
 
-    # Add handlers to the logger
-    logger.addHandler(c_handler)
-    logger.addHandler(f_handler)
+    # Hand records to a background listener that owns the real handlers
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, c_handler, f_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    q_handler = DeferredQueueHandler(log_queue)
+    q_handler.addFilter(RateLimitFilter(rate_limit_seconds))
+    logger.addHandler(q_handler)
 
     return logger
 
@@ -33,7 +95,8 @@ class Config:
     CHECK_NEW_CLIENT = float(os.getenv('CHECK_NEW_CLIENT', 0.65))  # Similarity threshold for clients
     EMPLOYEE_SIMILARITY_THRESHOLD = float(os.getenv('EMPLOYEE_SIMILARITY_THRESHOLD', 0.65))  # Similarity threshold for employees
     MIN_DETECTION_CONFIDENCE = float(os.getenv('MIN_DETECTION_CONFIDENCE', 0.6))  # Minimum face detection confidence
-    logger = setup_logger('MainRunner', 'logs/main.log')
+    LOG_RATE_LIMIT_SECONDS = float(os.getenv('LOG_RATE_LIMIT_SECONDS', 10))  # Repeated warnings are logged once per window; 0 disables
+    logger = setup_logger('MainRunner', 'logs/main.log', rate_limit_seconds=LOG_RATE_LIMIT_SECONDS)
     DIMENSIONS = int(os.getenv('DIMENSIONS', 512))
     DET_SIZE = tuple(map(int, os.getenv('DET_SIZE', '640,640').split(',')))
     API_BASE_URL = os.getenv('API_BASE_URL', 'http://10.30.10.136:8000')
@@ -46,3 +109,67 @@ class Config:
     REPORT_COOLDOWN_SECONDS = int(os.getenv('REPORT_COOLDOWN_SECONDS', 60))  # Cooldown period for sending reports
 
     POSE_THRESHOLD = int(os.getenv('POSE_THRESHOLD', 30))  # Pose angle threshold
+    MODEL_WARMUP = os.getenv('MODEL_WARMUP', 'true').lower() == 'true'  # Run the models once on a dummy frame at startup
+
+    PROCESS_ALL_FACES = os.getenv('PROCESS_ALL_FACES', 'false').lower() == 'true'  # Report every face in a frame, not just the best one
+
+    CLIENT_MERGE_THRESHOLD = float(os.getenv('CLIENT_MERGE_THRESHOLD', 0.75))  # Similarity above which two clients are merged
+    CLIENT_COMPACTION_INTERVAL_SECONDS = int(os.getenv('CLIENT_COMPACTION_INTERVAL_SECONDS', 3600))  # 0 disables the compaction job
+    CLIENT_COMPACTION_BATCH_SIZE = int(os.getenv('CLIENT_COMPACTION_BATCH_SIZE', 1000))  # Clients checked per range search
+    CLIENT_COMPACTION_PAUSE_SECONDS = float(os.getenv('CLIENT_COMPACTION_PAUSE_SECONDS', 0.5))  # Pause between batches so live matching can take the lock
+    CLIENT_MERGE_ENDPOINT = os.getenv('CLIENT_MERGE_ENDPOINT', '/client/merge')
+
+    MAX_TEMPLATES_PER_PERSON = int(os.getenv('MAX_TEMPLATES_PER_PERSON', 5))  # Reference embedding plus live captures kept per person
+    TEMPLATE_CAPTURE_THRESHOLD = float(os.getenv('TEMPLATE_CAPTURE_THRESHOLD', 0.75))  # Minimum match similarity to keep a live capture as a template
+    TEMPLATE_DUPLICATE_THRESHOLD = float(os.getenv('TEMPLATE_DUPLICATE_THRESHOLD', 0.95))  # Captures this close to an existing template are skipped
+    TEMPLATE_SEARCH_K = int(os.getenv('TEMPLATE_SEARCH_K', 10))  # Template hits fetched per query before aggregating per person
+    TEMPLATE_AGGREGATION = os.getenv('TEMPLATE_AGGREGATION', 'max')  # 'max' or 'mean' over a person's matching templates
+
+    WS_MAX_CONCURRENCY = int(os.getenv('WS_MAX_CONCURRENCY', 4))  # WebSocket updates embedded in parallel
+    WS_RECONNECT_MIN_SECONDS = float(os.getenv('WS_RECONNECT_MIN_SECONDS', 1))
+    WS_RECONNECT_MAX_SECONDS = float(os.getenv('WS_RECONNECT_MAX_SECONDS', 60))
+
+    SNAPSHOT_BATCH_WINDOW_SECONDS = float(os.getenv('SNAPSHOT_BATCH_WINDOW_SECONDS', 0.05))  # Writes landing within this window share one published snapshot
+    GALLERY_MAX_DEAD_FRACTION = float(os.getenv('GALLERY_MAX_DEAD_FRACTION', 0.2))  # Share of replaced rows after which a gallery segment is rewritten
+    GALLERY_METRICS_INTERVAL_SECONDS = float(os.getenv('GALLERY_METRICS_INTERVAL_SECONDS', 300))  # How often gallery contention metrics are logged
+
+    GALLERY_STORAGE = os.getenv('GALLERY_STORAGE', 'float32')  # In-memory template codes: float32, float16, int8 or pq
+    PQ_SUBQUANTIZERS = int(os.getenv('PQ_SUBQUANTIZERS', 64))  # Bytes per template with pq storage; must divide DIMENSIONS
+    CODEC_TRAIN_SIZE = int(os.getenv('CODEC_TRAIN_SIZE', 100000))  # Templates sampled to train int8/pq codecs
+    RECALL_SAMPLE_SIZE = int(os.getenv('RECALL_SAMPLE_SIZE', 200))  # Templates used to measure recall loss after loading
+
+    WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', 0))  # 0 processes images on a thread in the main process
+    SHARED_GALLERY_DIR = os.getenv('SHARED_GALLERY_DIR', '/dev/shm/attendify_gallery')  # Where worker processes map the gallery from
+    SHARED_GALLERY_MIN_INTERVAL_SECONDS = float(os.getenv('SHARED_GALLERY_MIN_INTERVAL_SECONDS', 1))  # Minimum time between shared gallery writes
+
+    SEARCH_SERVICE_ENABLED = os.getenv('SEARCH_SERVICE_ENABLED', 'false').lower() == 'true'  # Expose the gallery to local tools
+    SEARCH_SERVICE_SOCKET = os.getenv('SEARCH_SERVICE_SOCKET', '')  # Unix socket path; when empty the service listens on HOST:PORT
+    SEARCH_SERVICE_HOST = os.getenv('SEARCH_SERVICE_HOST', '127.0.0.1')
+    SEARCH_SERVICE_PORT = int(os.getenv('SEARCH_SERVICE_PORT', 8765))
+    SEARCH_DEFAULT_K = int(os.getenv('SEARCH_DEFAULT_K', 5))
+    SEARCH_BATCH_MAX_QUERIES = int(os.getenv('SEARCH_BATCH_MAX_QUERIES', 256))  # Embeddings merged into one index query
+    SEARCH_BATCH_WAIT_SECONDS = float(os.getenv('SEARCH_BATCH_WAIT_SECONDS', 0.002))  # How long a request waits for others to join its batch
+
+    INGEST_ENABLED = os.getenv('INGEST_ENABLED', 'false').lower() == 'true'  # Accept JPEG frames over HTTP instead of only the watched folder
+    INGEST_SOCKET = os.getenv('INGEST_SOCKET', '')  # Unix socket path; when empty the endpoint listens on HOST:PORT
+    INGEST_HOST = os.getenv('INGEST_HOST', '127.0.0.1')
+    INGEST_PORT = int(os.getenv('INGEST_PORT', 8766))
+    INGEST_MAX_BYTES = int(os.getenv('INGEST_MAX_BYTES', 10 * 1024 * 1024))  # Largest accepted frame
+    INGEST_MAX_QUEUE = int(os.getenv('INGEST_MAX_QUEUE', 100))  # Frames rejected with 503 once this many are waiting
+
+    UPLOAD_IMAGE_MODE = os.getenv('UPLOAD_IMAGE_MODE', 'original')  # original (source JPEG as is), frame (re-encoded frame) or face (re-encoded face crop)
+    UPLOAD_CROP_MARGIN = float(os.getenv('UPLOAD_CROP_MARGIN', 0.5))  # Margin around the face bbox, as a fraction of its width/height
+    UPLOAD_MAX_SIZE = int(os.getenv('UPLOAD_MAX_SIZE', 0))  # Longest side of a re-encoded upload in pixels; 0 keeps the size
+    UPLOAD_JPEG_QUALITY = int(os.getenv('UPLOAD_JPEG_QUALITY', 85))  # JPEG quality of re-encoded uploads
+    UPLOAD_ASYNC = os.getenv('UPLOAD_ASYNC', 'false').lower() == 'true'  # Send the attendance record first and upload its image in the background
+    UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', 2))  # Background image upload threads
+    UPLOAD_MAX_PENDING = int(os.getenv('UPLOAD_MAX_PENDING', 100))  # Background uploads queued at most; images past it are dropped
+    ATTENDANCE_IMAGE_ENDPOINT = os.getenv('ATTENDANCE_IMAGE_ENDPOINT', '/attendance/{attendance_id}/image')
+
+    TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0))  # Share of frames traced span by span; 0 disables tracing
+    TRACE_PROFILE_RATE = float(os.getenv('TRACE_PROFILE_RATE', 0))  # Share of traced frames also run under cProfile (adds noticeable overhead)
+    TRACE_FILE = os.getenv('TRACE_FILE', 'logs/trace.jsonl')
+    TRACE_FILE_MAX_BYTES = int(os.getenv('TRACE_FILE_MAX_BYTES', 50 * 1024 * 1024))  # Trace file size before rotation
+    TRACE_FILE_BACKUPS = int(os.getenv('TRACE_FILE_BACKUPS', 5))  # Rotated trace files kept
+    TRACE_SLOW_FRAME_SECONDS = float(os.getenv('TRACE_SLOW_FRAME_SECONDS', 2))  # Traced frames slower than this keep their image and profile
+    TRACE_SLOW_FRAME_DIR = os.getenv('TRACE_SLOW_FRAME_DIR', 'logs/slow_frames')
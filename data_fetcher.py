@@ -4,8 +4,12 @@ import requests
 from config import Config
 from funcs import get_embedding_from_url
 
-def fetch_and_store_data(db_manager, face_processor):
-    Config.logger.info("Starting fetch_and_store_data task")
+def fetch_and_store_data(db_manager, face_processor, incremental=False):
+    """Sync employees and clients from the backend.
+
+    With incremental=True, people whose photo is unchanged since the last sync are not re-embedded.
+    """
+    Config.logger.info(f"Starting fetch_and_store_data task (incremental={incremental})")
 
     try:
         headers = {'Authorization': f'Bearer {Config.API_TOKEN}'}
@@ -15,13 +19,16 @@ def fetch_and_store_data(db_manager, face_processor):
         employees = employees_response.json()
 
         fetched_employee_ids = [emp['id'] for emp in employees]
+        known_employee_images = db_manager.get_employee_images() if incremental else {}
 
         # Process and store employee embeddings
         for employee in employees:
+            if known_employee_images.get(employee['id']) == employee['image']:
+                continue
             image_url = f"{Config.API_BASE_URL}/{employee['image']}"
             embedding = get_embedding_from_url(image_url, face_processor)
             if embedding is not None:
-                db_manager.add_employee_embedding(employee['id'], embedding)
+                db_manager.add_employee_embedding(employee['id'], embedding, image=employee['image'])
             else:
                 Config.logger.error(f"Failed to get embedding for Employee ID: {employee['id']}")
 
@@ -34,13 +41,16 @@ def fetch_and_store_data(db_manager, face_processor):
         clients = clients_response.json()
 
         fetched_client_ids = [cli['id'] for cli in clients]
+        known_client_images = db_manager.get_client_images() if incremental else {}
 
         # Process and store client embeddings
         for client in clients:
+            if known_client_images.get(client['id']) == client['image']:
+                continue
             image_url = f"{Config.API_BASE_URL}/{client['image']}"
             embedding = get_embedding_from_url(image_url, face_processor)
             if embedding is not None:
-                db_manager.add_client_embedding(client['id'], embedding)
+                db_manager.add_client_embedding(client['id'], embedding, image=client['image'])
                 Config.logger.info(f"Stored/Updated embedding for Client ID: {client['id']}")
             else:
                 Config.logger.error(f"Failed to get embedding for Client ID: {client['id']}")
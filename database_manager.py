@@ -1,14 +1,16 @@
 # database_manager.py
 
-import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import faiss
 from pymongo import MongoClient
 from datetime import datetime
 from config import Config
 import os
 
-from funcs import compute_sim
+from funcs import aggregate_template_scores, compact_templates
+from gallery import Gallery
+from tracing import span
 
 
 class DatabaseManager:
@@ -18,205 +20,285 @@ class DatabaseManager:
         self.employees_collection = self.mongo_db.employees
         self.clients_collection = self.mongo_db.clients
 
-        # Initialize Faiss indexes with Inner Product for cosine similarity
+        # Searches run lock-free on each gallery's published snapshot (inner product on normalized
+        # vectors, i.e. cosine similarity); writers go through the gallery's write lock
         self.DIMENSIONS = Config.DIMENSIONS
-        self.faiss_index_employee = faiss.IndexIDMap(faiss.IndexFlatIP(self.DIMENSIONS))
-        self.faiss_index_client = faiss.IndexIDMap(faiss.IndexFlatIP(self.DIMENSIONS))
-        self.lock = threading.Lock()
-
-        # Maintain a mapping from person_id to embedding
-        self.employee_embeddings_map = {}
-        self.client_embeddings_map = {}
+        self.employee_gallery = Gallery("Employee", self.DIMENSIONS)
+        self.client_gallery = Gallery("Client", self.DIMENSIONS)
 
         self.load_faiss_indexes()
 
     def load_faiss_indexes(self):
-        with self.lock:
-            Config.logger.info("Loading Faiss indexes for employees and clients.")
-
-            # Reset the indexes
-            self.faiss_index_employee = faiss.IndexIDMap(faiss.IndexFlatIP(self.DIMENSIONS))
-            self.faiss_index_client = faiss.IndexIDMap(faiss.IndexFlatIP(self.DIMENSIONS))
-            self.employee_embeddings_map = {}
-            self.client_embeddings_map = {}
-
-            # Load employee embeddings
-            employee_embeddings = []
-            employee_ids = []
-            for emp in self.employees_collection.find({"embedding": {"$exists": True}}):
-                embedding = np.array(emp['embedding']).astype('float32')
-                if embedding.shape[0] != self.DIMENSIONS:
-                    Config.logger.warning(f"Employee ID {emp['person_id']} has invalid embedding shape.")
-                    continue
-                norm = np.linalg.norm(embedding)
-                if norm == 0:
-                    Config.logger.warning(f"Employee ID {emp['person_id']} has zero norm embedding.")
-                    continue
-                embedding = embedding / norm  # Normalize for cosine similarity
-                employee_embeddings.append(embedding)
-                employee_ids.append(emp['person_id'])
-                self.employee_embeddings_map[emp['person_id']] = embedding
-
-            if employee_embeddings:
-                employee_embeddings = np.array(employee_embeddings)
-                faiss.normalize_L2(employee_embeddings)  # Ensure normalization
-                self.faiss_index_employee.add_with_ids(employee_embeddings, np.array(employee_ids))
-                Config.logger.info(f"Loaded {len(employee_embeddings)} employee embeddings into Faiss index.")
-            else:
-                Config.logger.warning("No employee embeddings loaded into Faiss index.")
-
-            # Load client embeddings
-            client_embeddings = []
-            client_ids = []
-            for cli in self.clients_collection.find({"embedding": {"$exists": True}}):
-                embedding = np.array(cli['embedding']).astype('float32')
-                if embedding.shape[0] != self.DIMENSIONS:
-                    Config.logger.warning(f"Client ID {cli['person_id']} has invalid embedding shape.")
-                    continue
-                norm = np.linalg.norm(embedding)
-                if norm == 0:
-                    Config.logger.warning(f"Client ID {cli['person_id']} has zero norm embedding.")
-                    continue
-                embedding = embedding / norm  # Normalize for cosine similarity
-                client_embeddings.append(embedding)
-                client_ids.append(cli['person_id'])
-                self.client_embeddings_map[cli['person_id']] = embedding
-
-            if client_embeddings:
-                client_embeddings = np.array(client_embeddings)
-                faiss.normalize_L2(client_embeddings)  # Ensure normalization
-                self.faiss_index_client.add_with_ids(client_embeddings, np.array(client_ids))
-                Config.logger.info(f"Loaded {len(client_embeddings)} client embeddings into Faiss index.")
-            else:
-                Config.logger.warning("No client embeddings loaded into Faiss index.")
-
-    def add_employee_embedding(self, person_id, embedding):
-        with self.lock:
-            # norm = np.linalg.norm(embedding)
-            # if norm == 0:
-            #     Config.logger.error(f"Cannot add employee {person_id} with zero norm embedding.")
-            #     return
-            # embedding = embedding / norm
-            self.employees_collection.update_one(
-                {"person_id": person_id},
-                {"$set": {
-                    "embedding": embedding.tolist(),
-                    "updated_at": datetime.now()
-                }},
-                upsert=True
-            )
-            self.faiss_index_employee.add_with_ids(
-                np.array([embedding]).astype('float32'),
-                np.array([person_id], dtype='int64')
+        Config.logger.info("Loading Faiss indexes for employees and clients.")
+        # The two collections are independent, so read and index them concurrently
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix="gallery-load") as executor:
+            loads = [
+                executor.submit(self._load_gallery, self.employee_gallery, self.employees_collection, "employees"),
+                executor.submit(self._load_gallery, self.client_gallery, self.clients_collection, "clients"),
+            ]
+            for load in loads:
+                load.result()
+
+    def _load_gallery(self, gallery, collection, people):
+        started = time.perf_counter()
+        templates = {}
+        for doc in collection.find({"embedding": {"$exists": True}}):
+            person_templates = self._load_templates(doc, gallery.label)
+            if person_templates is not None:
+                templates[doc['person_id']] = person_templates
+
+        gallery.reset(templates)
+        if templates:
+            Config.logger.info(
+                "Loaded %s templates for %s %s into Faiss index in %.2f s.",
+                len(gallery.snapshot), len(templates), people, time.perf_counter() - started
             )
-            self.employee_embeddings_map[person_id] = embedding
-            Config.logger.info(f"Stored/Updated embedding for Employee ID: {person_id}")
+        else:
+            Config.logger.warning("No %s embeddings loaded into Faiss index.", gallery.label.lower())
 
-    def add_client_embedding(self, person_id, embedding):
-        with self.lock:
+    def _load_templates(self, doc, label):
+        """Build the (n, DIMENSIONS) template matrix for a stored person: the reference embedding first, then live templates."""
+        templates = []
+        for raw in [doc['embedding']] + doc.get('templates', []):
+            embedding = np.array(raw).astype('float32')
+            if embedding.shape[0] != self.DIMENSIONS:
+                Config.logger.warning("%s ID %s has invalid embedding shape.", label, doc['person_id'])
+                continue
             norm = np.linalg.norm(embedding)
             if norm == 0:
-                Config.logger.error(f"Cannot add client {person_id} with zero norm embedding.")
-                return
-            embedding = embedding / norm
+                Config.logger.warning("%s ID %s has zero norm embedding.", label, doc['person_id'])
+                continue
+            templates.append(embedding / norm)  # Normalize for cosine similarity
+        if not templates:
+            return None
+        return np.array(templates)
+
+    def add_employee_embedding(self, person_id, embedding, image=None):
+        # norm = np.linalg.norm(embedding)
+        # if norm == 0:
+        #     Config.logger.error(f"Cannot add employee {person_id} with zero norm embedding.")
+        #     return
+        # embedding = embedding / norm
+        self.employees_collection.update_one(
+            {"person_id": person_id},
+            {"$set": self._embedding_fields(embedding, image)},
+            upsert=True
+        )
+        self._set_reference(self.employee_gallery, person_id, embedding)
+        Config.logger.info("Stored/Updated embedding for Employee ID: %s", person_id)
+
+    def add_client_embedding(self, person_id, embedding, image=None):
+        norm = np.linalg.norm(embedding)
+        if norm == 0:
+            Config.logger.error("Cannot add client %s with zero norm embedding.", person_id)
+            return
+        embedding = embedding / norm
+        with span('add_client_embedding'):
             self.clients_collection.update_one(
                 {"person_id": person_id},
-                {"$set": {
-                    "embedding": embedding.tolist(),
-                    "updated_at": datetime.now()
-                }},
+                {"$set": self._embedding_fields(embedding, image)},
                 upsert=True
             )
-            self.faiss_index_client.add_with_ids(
-                np.array([embedding]).astype('float32'),
-                np.array([person_id], dtype='int64')
-            )
-            self.client_embeddings_map[person_id] = embedding
-            Config.logger.info(f"Stored/Updated embedding for Client ID: {person_id}")
+            self._set_reference(self.client_gallery, person_id, embedding)
+        Config.logger.info("Stored/Updated embedding for Client ID: %s", person_id)
+
+    def _set_reference(self, gallery, person_id, embedding):
+        """Replace the reference template and keep the live ones."""
+        with gallery.write():
+            templates = gallery.get(person_id)
+            templates = np.vstack([embedding, templates[1:]]) if templates is not None else np.array([embedding])
+            gallery.set_templates(person_id, templates)
+
+    def _embedding_fields(self, embedding, image):
+        fields = {
+            "embedding": embedding.tolist(),
+            "updated_at": datetime.now()
+        }
+        if image is not None:
+            # Remember the source photo so incremental syncs can skip unchanged people
+            fields["image"] = image
+        return fields
+
+    def get_employee_images(self):
+        """Return {person_id: image} for employees whose embedding came from a known backend photo."""
+        return {
+            emp['person_id']: emp['image']
+            for emp in self.employees_collection.find({"image": {"$exists": True}}, {"person_id": 1, "image": 1})
+        }
+
+    def get_client_images(self):
+        """Return {person_id: image} for clients whose embedding came from a known backend photo."""
+        return {
+            cli['person_id']: cli['image']
+            for cli in self.clients_collection.find({"image": {"$exists": True}}, {"person_id": 1, "image": 1})
+        }
+
+    def add_employee_template(self, person_id, embedding):
+        """Keep a confident live capture as an extra template for the employee."""
+        with span('add_template', gallery=self.employee_gallery.label), self.employee_gallery.write():
+            self._add_template(self.employee_gallery, self.employees_collection, person_id, [embedding])
+
+    def add_client_template(self, person_id, embedding):
+        """Keep a confident live capture as an extra template for the client."""
+        with span('add_template', gallery=self.client_gallery.label), self.client_gallery.write():
+            self._add_template(self.client_gallery, self.clients_collection, person_id, [embedding])
+
+    def _add_template(self, gallery, collection, person_id, embeddings):
+        """Append live templates and compact them. Call while holding gallery.write()."""
+        templates = gallery.get(person_id)
+        if templates is None or Config.MAX_TEMPLATES_PER_PERSON <= 1:
+            return
+        live = [templates[1:]]
+        for embedding in embeddings:
+            norm = np.linalg.norm(embedding)
+            if norm == 0:
+                continue
+            embedding = embedding / norm
+            # Skip captures that add nothing over an existing template
+            if np.max(templates @ embedding) >= Config.TEMPLATE_DUPLICATE_THRESHOLD:
+                continue
+            live.append(embedding[np.newaxis, :])
+        live = np.vstack(live).astype('float32')
+        if len(live) == len(templates) - 1:
+            return
+        live = compact_templates(live, Config.MAX_TEMPLATES_PER_PERSON - 1)
+        collection.update_one(
+            {"person_id": person_id},
+            {"$set": {
+                "templates": live.tolist(),
+                "updated_at": datetime.now()
+            }}
+        )
+        gallery.set_templates(person_id, np.vstack([templates[:1], live]))
+        Config.logger.debug("Person ID %s now has %s templates", person_id, len(live) + 1)
 
     def remove_employee_embedding(self, person_id):
-        with self.lock:
-            self.employees_collection.delete_one({"person_id": person_id})
-            self.employee_embeddings_map.pop(person_id, None)
-            try:
-                self.faiss_index_employee.remove_ids(np.array([person_id], dtype='int64'))
-                Config.logger.info(f"Removed embedding for Employee ID: {person_id}")
-            except Exception as e:
-                Config.logger.error(f"Error removing embedding from Faiss index: {e}")
+        self.employees_collection.delete_one({"person_id": person_id})
+        with self.employee_gallery.write():
+            self.employee_gallery.remove(person_id)
+        Config.logger.info("Removed embedding for Employee ID: %s", person_id)
 
     def remove_client_embedding(self, person_id):
-        with self.lock:
-            self.clients_collection.delete_one({"person_id": person_id})
-            self.client_embeddings_map.pop(person_id, None)
-            try:
-                self.faiss_index_client.remove_ids(np.array([person_id], dtype='int64'))
-                Config.logger.info(f"Removed embedding for Client ID: {person_id}")
-            except Exception as e:
-                Config.logger.error(f"Error removing embedding from Faiss index: {e}")
+        self.clients_collection.delete_one({"person_id": person_id})
+        with self.client_gallery.write():
+            self.client_gallery.remove(person_id)
+        Config.logger.info("Removed embedding for Client ID: %s", person_id)
 
     def remove_deleted_employees(self, fetched_employee_ids):
-        with self.lock:
-            deleted_employees = self.employees_collection.find({"person_id": {"$nin": fetched_employee_ids}})
-            deleted_employee_ids = [emp['person_id'] for emp in deleted_employees]
-
-            if deleted_employee_ids:
-                try:
-                    self.employees_collection.delete_many({"person_id": {"$in": deleted_employee_ids}})
-                    Config.logger.info(f"Removed deleted employees: {deleted_employee_ids}")
-                    # Rebuild Faiss index
-                    self.load_faiss_indexes()
-                except Exception as e:
-                    Config.logger.error(f"Error removing deleted employees: {e}")
+        deleted_employees = self.employees_collection.find({"person_id": {"$nin": fetched_employee_ids}})
+        deleted_employee_ids = [emp['person_id'] for emp in deleted_employees]
+
+        if deleted_employee_ids:
+            try:
+                self.employees_collection.delete_many({"person_id": {"$in": deleted_employee_ids}})
+                Config.logger.info("Removed deleted employees: %s", deleted_employee_ids)
+                with self.employee_gallery.write():
+                    for person_id in deleted_employee_ids:
+                        self.employee_gallery.remove(person_id)
+            except Exception as e:
+                Config.logger.error("Error removing deleted employees: %s", e)
 
     def remove_deleted_clients(self, fetched_client_ids):
-        with self.lock:
-            deleted_clients = self.clients_collection.find({"person_id": {"$nin": fetched_client_ids}})
-            deleted_client_ids = [cli['person_id'] for cli in deleted_clients]
+        deleted_clients = self.clients_collection.find({"person_id": {"$nin": fetched_client_ids}})
+        deleted_client_ids = [cli['person_id'] for cli in deleted_clients]
 
-            if deleted_client_ids:
-                try:
-                    self.clients_collection.delete_many({"person_id": {"$in": deleted_client_ids}})
-                    Config.logger.info(f"Removed deleted clients: {deleted_client_ids}")
-                    # Rebuild Faiss index
-                    self.load_faiss_indexes()
-                except Exception as e:
-                    Config.logger.error(f"Error removing deleted clients: {e}")
+        if deleted_client_ids:
+            try:
+                self.clients_collection.delete_many({"person_id": {"$in": deleted_client_ids}})
+                Config.logger.info("Removed deleted clients: %s", deleted_client_ids)
+                with self.client_gallery.write():
+                    for person_id in deleted_client_ids:
+                        self.client_gallery.remove(person_id)
+            except Exception as e:
+                Config.logger.error("Error removing deleted clients: %s", e)
 
+    def get_client_ids(self):
+        return self.client_gallery.person_ids()
 
-    def find_matching_employee(self, embedding):
-        with self.lock:
-            if not self.employee_embeddings_map:
-                return None, 0
+    def search_clients_range(self, person_ids, threshold):
+        """Return {person_id: [(other_id, similarity), ...]} for every other client above the threshold.
 
-            max_similarity = -1
-            best_employee = None
+        Every template of a client is queried; the best template pair decides the similarity.
+        """
+        templates = self.client_gallery.get_templates(person_ids)
+        person_ids = [pid for pid in person_ids if pid in templates]
+        if not person_ids:
+            return {}
+        queries = np.vstack([templates[pid] for pid in person_ids]).astype('float32')
+        owners = np.concatenate([[pid] * len(templates[pid]) for pid in person_ids])
+        lims, similarities, ids = self.client_gallery.range_search(queries, threshold)
 
-            for person_id, stored_embedding in self.employee_embeddings_map.items():
-                similarity = compute_sim(embedding, stored_embedding)
-                if similarity is not None and similarity > max_similarity:
-                    max_similarity = similarity
-                    best_employee = self.employees_collection.find_one({"person_id": person_id})
+        best = {person_id: {} for person_id in person_ids}
+        for row, person_id in enumerate(owners):
+            for other_id, similarity in zip(ids[lims[row]:lims[row + 1]], similarities[lims[row]:lims[row + 1]]):
+                other_id = int(other_id)
+                if other_id != person_id and similarity > best[person_id].get(other_id, -1):
+                    best[person_id][other_id] = float(similarity)
+        return {person_id: list(others.items()) for person_id, others in best.items()}
 
-            if max_similarity > Config.EMPLOYEE_SIMILARITY_THRESHOLD:
-                return best_employee, max_similarity
-            else:
-                return None, 0
+    def merge_clients(self, canonical_id, duplicate_ids):
+        """Fold duplicate clients into canonical_id as templates, then drop them from Mongo and the gallery."""
+        with self.client_gallery.write():
+            duplicate_templates = [
+                template
+                for person_id in duplicate_ids if self.client_gallery.get(person_id) is not None
+                for template in self.client_gallery.get(person_id)
+            ]
+            self._add_template(self.client_gallery, self.clients_collection, canonical_id, duplicate_templates)
+            for person_id in duplicate_ids:
+                self.client_gallery.remove(person_id)
+        self.clients_collection.delete_many({"person_id": {"$in": duplicate_ids}})
+        Config.logger.info("Merged clients %s into Client ID: %s", duplicate_ids, canonical_id)
+
+    def get_metrics(self):
+        """Lock contention and snapshot publish metrics for both galleries."""
+        return {
+            'employee': self.employee_gallery.metrics(),
+            'client': self.client_gallery.metrics(),
+        }
+
+    def find_matching_employee(self, embedding):
+        return self.find_matching_employees([embedding])[0]
 
     def find_matching_client(self, embedding):
-        with self.lock:
-            if not self.client_embeddings_map:
-                return None, 0
+        return self.find_matching_clients([embedding])[0]
+
+    def find_matching_employees(self, embeddings):
+        """Match a batch of embeddings against employees with a single index query."""
+        return self._find_matches(
+            self.employee_gallery, self.employees_collection, embeddings, Config.EMPLOYEE_SIMILARITY_THRESHOLD
+        )
 
-            max_similarity = -1
-            best_client = None
+    def find_matching_clients(self, embeddings):
+        """Match a batch of embeddings against clients with a single index query."""
+        return self._find_matches(
+            self.client_gallery, self.clients_collection, embeddings, Config.CHECK_NEW_CLIENT
+        )
 
-            for person_id, stored_embedding in self.client_embeddings_map.items():
-                similarity = compute_sim(embedding, stored_embedding)
-                if similarity is not None and similarity > max_similarity:
-                    max_similarity = similarity
-                    best_client = self.clients_collection.find_one({"person_id": person_id})
+    def _find_matches(self, gallery, collection, embeddings, threshold):
+        """Return one (document, similarity) pair per embedding, or (None, 0) when nothing passes the threshold."""
+        if len(embeddings) == 0:
+            return []
+        queries = np.asarray(embeddings, dtype='float32').reshape(-1, self.DIMENSIONS)
+        with span('gallery_search', gallery=gallery.label, queries=len(queries)):
+            similarities, ids = gallery.search(queries, Config.TEMPLATE_SEARCH_K)
+        best_matches = [aggregate_template_scores(row_ids, row_sims) for row_ids, row_sims in zip(ids, similarities)]
+        matched_ids = list({
+            person_id for person_id, similarity in best_matches
+            if person_id is not None and similarity > threshold
+        })
+        documents = {}
+        if matched_ids:
+            # One lookup for every person matched in the batch
+            with span('mongo_find', collection=collection.name):
+                for doc in collection.find({"person_id": {"$in": matched_ids}}):
+                    documents[doc['person_id']] = doc
 
-            if max_similarity > Config.CHECK_NEW_CLIENT:
-                return best_client, max_similarity
+        results = []
+        for person_id, similarity in best_matches:
+            document = documents.get(person_id) if similarity > threshold else None
+            if document:
+                results.append((document, similarity))
             else:
-                return None, 0
+                results.append((None, 0))
+        return results
@@ -0,0 +1,179 @@
+# evaluate_thresholds.py
+
+import argparse
+import csv
+import os
+import time
+import cv2
+import numpy as np
+from config import Config
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+SCORE_BINS = 2000  # Similarity histogram resolution over [-1, 1]
+
+
+def list_labelled_images(folder):
+    """Return (paths, labels) for a folder laid out as <folder>/<person>/<image>."""
+    paths, labels = [], []
+    for label in sorted(os.listdir(folder)):
+        person_dir = os.path.join(folder, label)
+        if not os.path.isdir(person_dir):
+            continue
+        for filename in sorted(os.listdir(person_dir)):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(person_dir, filename))
+                labels.append(label)
+    return paths, labels
+
+
+def load_embeddings(folder, cache_path):
+    """Embed every labelled image once, reusing cached embeddings of files that did not change.
+
+    Returns (paths, labels, embeddings) for the images where a face was found.
+    """
+    paths, labels = list_labelled_images(folder)
+    mtimes = {path: os.path.getmtime(path) for path in paths}
+
+    cached = {}
+    if cache_path and os.path.exists(cache_path):
+        with np.load(cache_path, allow_pickle=False) as cache:
+            for path, mtime, embedding in zip(cache['paths'], cache['mtimes'], cache['embeddings']):
+                cached[str(path)] = (float(mtime), embedding)
+        Config.logger.info("Loaded %s cached embeddings from %s", len(cached), cache_path)
+
+    missing = [path for path in paths if path not in cached or cached[path][0] != mtimes[path]]
+    if missing:
+        from face_processor import FaceProcessor
+
+        face_processor = FaceProcessor()
+        started = time.perf_counter()
+        for count, path in enumerate(missing, 1):
+            image = cv2.imread(path)
+            embedding = None
+            if image is not None:
+                embedding, _, _ = face_processor.get_embedding_from_image(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+            if embedding is None:
+                Config.logger.warning("No face embedding found in image: %s", path)
+                embedding = np.zeros(Config.DIMENSIONS, dtype='float32')
+            cached[path] = (mtimes[path], np.asarray(embedding, dtype='float32'))
+            if count % 500 == 0:
+                Config.logger.info("Embedded %s of %s images (%.1f images/s)", count, len(missing), count / (time.perf_counter() - started))
+
+        if cache_path:
+            np.savez(
+                cache_path,
+                paths=np.array(paths),
+                mtimes=np.array([mtimes[path] for path in paths]),
+                embeddings=np.vstack([cached[path][1] for path in paths]) if paths else np.zeros((0, Config.DIMENSIONS), dtype='float32'),
+            )
+            Config.logger.info("Saved %s embeddings to %s", len(paths), cache_path)
+
+    # Zero rows mark images without a usable face
+    keep = [i for i, path in enumerate(paths) if np.any(cached[path][1])]
+    if len(keep) < len(paths):
+        Config.logger.warning("Skipping %s of %s images without a face", len(paths) - len(keep), len(paths))
+    embeddings = np.vstack([cached[paths[i]][1] for i in keep]) if keep else np.zeros((0, Config.DIMENSIONS), dtype='float32')
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return [paths[i] for i in keep], [labels[i] for i in keep], embeddings
+
+
+def score_histograms(embeddings, labels, block_rows=1024):
+    """Histogram the cosine similarity of every image pair, split into genuine (same person) and impostor pairs.
+
+    Pairs are scored block by block with matrix multiplies, so memory stays at
+    block_rows x n similarities however large the set is.
+    """
+    _, label_ids = np.unique(np.asarray(labels), return_inverse=True)
+    genuine = np.zeros(SCORE_BINS, dtype='int64')
+    impostor = np.zeros(SCORE_BINS, dtype='int64')
+    n = len(embeddings)
+    for start in range(0, n, block_rows):
+        stop = min(start + block_rows, n)
+        # Only pairs (i, j) with j > i, so each pair is counted once
+        similarities = embeddings[start:stop] @ embeddings[start:].T
+        upper = np.arange(start, n)[np.newaxis, :] > np.arange(start, stop)[:, np.newaxis]
+        same = label_ids[start:stop, np.newaxis] == label_ids[np.newaxis, start:]
+        bins = np.clip(((similarities + 1) * (SCORE_BINS / 2)).astype('int64'), 0, SCORE_BINS - 1)
+        genuine += np.bincount(bins[upper & same], minlength=SCORE_BINS)
+        impostor += np.bincount(bins[upper & ~same], minlength=SCORE_BINS)
+    return genuine, impostor
+
+
+def error_curves(genuine, impostor):
+    """Return (thresholds, far, frr) for a match rule of similarity >= threshold at every histogram bin edge."""
+    thresholds = np.linspace(-1, 1, SCORE_BINS, endpoint=False)
+    # Pairs scoring at or above each bin edge
+    genuine_accepted = np.cumsum(genuine[::-1])[::-1]
+    impostor_accepted = np.cumsum(impostor[::-1])[::-1]
+    far = impostor_accepted / max(impostor.sum(), 1)
+    frr = 1 - genuine_accepted / max(genuine.sum(), 1)
+    return thresholds, far, frr
+
+
+def summarize(thresholds, far, frr, target_fars):
+    """Equal error rate, the lowest threshold meeting each target FAR, and the configured thresholds."""
+    eer_index = int(np.argmin(np.abs(far - frr)))
+    summary = {
+        'eer': {'threshold': thresholds[eer_index], 'far': far[eer_index], 'frr': frr[eer_index]},
+        'targets': {},
+        'configured': {},
+    }
+    for target in target_fars:
+        meeting = np.nonzero(far <= target)[0]
+        if len(meeting):
+            i = meeting[0]
+            summary['targets'][target] = {'threshold': thresholds[i], 'far': far[i], 'frr': frr[i]}
+    for name in ('EMPLOYEE_SIMILARITY_THRESHOLD', 'CHECK_NEW_CLIENT'):
+        threshold = getattr(Config, name)
+        i = min(int(np.searchsorted(thresholds, threshold)), len(thresholds) - 1)
+        summary['configured'][name] = {'threshold': threshold, 'far': far[i], 'frr': frr[i]}
+    return summary
+
+
+def write_curves(path, thresholds, far, frr, genuine, impostor):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['threshold', 'far', 'frr', 'tar', 'genuine_pairs', 'impostor_pairs'])
+        for row in zip(thresholds, far, frr, 1 - frr, genuine, impostor):
+            writer.writerow([f"{row[0]:.3f}", f"{row[1]:.8f}", f"{row[2]:.8f}", f"{row[3]:.8f}", row[4], row[5]])
+
+
+def evaluate(folder, cache_path, curves_path, target_fars, block_rows):
+    paths, labels, embeddings = load_embeddings(folder, cache_path)
+    people = len(set(labels))
+    if people < 2:
+        raise SystemExit("Need images of at least two people to measure impostor scores.")
+
+    started = time.perf_counter()
+    genuine, impostor = score_histograms(embeddings, labels, block_rows)
+    Config.logger.info(
+        "Scored %s genuine and %s impostor pairs in %.2f s", genuine.sum(), impostor.sum(), time.perf_counter() - started
+    )
+    thresholds, far, frr = error_curves(genuine, impostor)
+    if curves_path:
+        write_curves(curves_path, thresholds, far, frr, genuine, impostor)
+
+    summary = summarize(thresholds, far, frr, target_fars)
+    print(f"{len(paths)} images of {people} people: {genuine.sum()} genuine pairs, {impostor.sum()} impostor pairs")
+    eer = summary['eer']
+    print(f"EER {eer['far']:.4%} at threshold {eer['threshold']:.3f}")
+    for target, point in summary['targets'].items():
+        print(f"FAR <= {target:g}: threshold {point['threshold']:.3f} (FAR {point['far']:.2e}, FRR {point['frr']:.4%})")
+    for name, point in summary['configured'].items():
+        print(f"{name}={point['threshold']}: FAR {point['far']:.2e}, FRR {point['frr']:.4%}")
+    if curves_path:
+        print(f"ROC/FAR/FRR curves written to {curves_path}")
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Measure genuine/impostor similarity on a labelled photo folder (<folder>/<person>/<image>) and recommend thresholds."
+    )
+    parser.add_argument('folder')
+    parser.add_argument('--cache', default='embeddings_cache.npz', help="Embedding cache file; only new or changed images are embedded")
+    parser.add_argument('--curves', default='threshold_curves.csv', help="CSV with FAR, FRR and TAR per threshold")
+    parser.add_argument('--target-far', type=float, nargs='+', default=[1e-3, 1e-4, 1e-5])
+    parser.add_argument('--block-rows', type=int, default=1024, help="Embeddings scored per matrix multiply")
+    args = parser.parse_args()
+    evaluate(args.folder, args.cache, args.curves, args.target_far, args.block_rows)
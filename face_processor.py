@@ -1,12 +1,15 @@
 # face_processor.py
 
 # import torch
+import time
 import cv2
 import numpy as np
 from insightface.app import FaceAnalysis
+from insightface.app.common import Face
+from insightface.utils import face_align
 import logging
 from config import Config
-from funcs import get_faces_data
+from funcs import get_faces_data, get_all_faces_data
 
 class FaceProcessor:
     def __init__(self):
@@ -15,29 +18,106 @@ class FaceProcessor:
         logging.info(f"Using provider: {self.provider}")
         self.app = FaceAnalysis(name='buffalo_l', providers=[self.provider])
         self.app.prepare(ctx_id=0)
+        self.rec_model = self.app.models['recognition']
+        if Config.MODEL_WARMUP:
+            self.warm_up()
+
+    def warm_up(self):
+        """Run every model once on a dummy frame so the first real frame does not pay for lazy initialization."""
+        started = time.perf_counter()
+        frame = np.zeros((Config.DET_SIZE[1], Config.DET_SIZE[0], 3), dtype=np.uint8)
+        self.app.det_model.detect(frame, max_num=0, metric='default')
+        # A black frame has no faces, so feed the other models a synthetic one
+        height, width = frame.shape[:2]
+        face = Face(
+            bbox=np.array([width / 4, height / 4, 3 * width / 4, 3 * height / 4], dtype=np.float32),
+            kps=None, det_score=1.0
+        )
+        for taskname, model in self.app.models.items():
+            if taskname not in ('detection', 'recognition'):
+                model.get(frame, face)
+        size = self.rec_model.input_size[0]
+        self.rec_model.get_feat([np.zeros((size, size, 3), dtype=np.uint8)])
+        Config.logger.info("Face models warmed up in %.2f s", time.perf_counter() - started)
+
+    def pose_exceeds_threshold(self, face):
+        return abs(face.pose[1]) > Config.POSE_THRESHOLD or abs(face.pose[0]) > Config.POSE_THRESHOLD
 
     def get_embedding_from_image(self, image):
+        embedding, age, gender, _ = self.get_best_face_from_image(image)
+        return embedding, age, gender
+
+    def get_best_face_from_image(self, image):
+        """Like get_embedding_from_image, but also return the face bbox: (embedding, age, gender, bbox)."""
         faces = self.app.get(image)
         if not faces:
-            return None, None, None
+            return None, None, None, None
         # Get the face with the highest detection score
         face = get_faces_data(faces, min_confidence=Config.MIN_DETECTION_CONFIDENCE)
         if face:
             # Pose check
-            if abs(face.pose[1]) > Config.POSE_THRESHOLD or abs(face.pose[0]) > Config.POSE_THRESHOLD:
-                Config.logger.warning(f"Face pose exceeds threshold: pose={face.pose}")
-                return None, None, None
+            if self.pose_exceeds_threshold(face):
+                Config.logger.warning("Face pose exceeds threshold: pose=%s", face.pose)
+                return None, None, None, None
 
             embedding = face.embedding
             # Normalize embedding
             norm = np.linalg.norm(embedding)
-            Config.logger.debug(f"Embedding norm: {norm}")
+            Config.logger.debug("Embedding norm: %s", norm)
             if norm == 0:
                 Config.logger.warning("Detected face has zero norm embedding.")
-                return None, None, None
+                return None, None, None, None
             embedding = embedding / norm
-            Config.logger.debug(f"Normalized embedding: {embedding}")
+            Config.logger.debug("Normalized embedding: %s", embedding)
+            age = getattr(face, 'age', None)
+            gender = getattr(face, 'gender', None)
+            return embedding, age, gender, face.bbox
+        return None, None, None, None
+
+    def detect_faces(self, image):
+        """Run detection and the attribute models (pose, age, gender) but not recognition."""
+        bboxes, kpss = self.app.det_model.detect(image, max_num=0, metric='default')
+        faces = []
+        for i in range(bboxes.shape[0]):
+            kps = kpss[i] if kpss is not None else None
+            face = Face(bbox=bboxes[i, 0:4], kps=kps, det_score=bboxes[i, 4])
+            for taskname, model in self.app.models.items():
+                if taskname in ('detection', 'recognition'):
+                    continue
+                model.get(image, face)
+            faces.append(face)
+        return faces
+
+    def get_embeddings_from_image(self, image):
+        """Embed every qualifying face in the image with a single batched recognition call.
+
+        Returns a list of (embedding, age, gender, bbox) tuples, highest detection score first.
+        """
+        faces = get_all_faces_data(self.detect_faces(image), min_confidence=Config.MIN_DETECTION_CONFIDENCE)
+        qualifying = []
+        for face in faces:
+            if self.pose_exceeds_threshold(face):
+                Config.logger.warning("Face pose exceeds threshold: pose=%s", face.pose)
+                continue
+            qualifying.append(face)
+        if not qualifying:
+            return []
+
+        # Align all faces and run recognition once for the whole batch
+        aligned = [
+            face_align.norm_crop(image, landmark=face.kps, image_size=self.rec_model.input_size[0])
+            for face in qualifying
+        ]
+        embeddings = self.rec_model.get_feat(aligned).astype('float32')
+        norms = np.linalg.norm(embeddings, axis=1)
+
+        results = []
+        for face, embedding, norm in zip(qualifying, embeddings, norms):
+            if norm == 0:
+                Config.logger.warning("Detected face has zero norm embedding.")
+                continue
             age = getattr(face, 'age', None)
             gender = getattr(face, 'gender', None)
-            return embedding, age, gender
-        return None, None, None
+            results.append((embedding / norm, age, gender, face.bbox))
+        Config.logger.debug("Embedded %s of %s detected faces", len(results), len(faces))
+        return results
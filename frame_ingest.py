@@ -0,0 +1,75 @@
+# frame_ingest.py
+
+import threading
+from datetime import datetime
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from config import Config
+from image_handler import Frame
+from search_service import JsonRequestHandler, UnixHTTPServer
+
+
+def parse_frame_timestamp(value):
+    """Accept the camera filename format (YYYYmmddHHMMSSffffff) or ISO 8601; default to now."""
+    if not value:
+        return datetime.now()
+    try:
+        return datetime.strptime(value, "%Y%m%d%H%M%S%f")
+    except ValueError:
+        return datetime.fromisoformat(value)
+
+
+class FrameIngestHandler(JsonRequestHandler):
+    """POST /frames?camera_id=1&timestamp=... with a JPEG body; the frame goes straight onto the processing queue.
+
+    GET /ready reports the startup state; frames are refused with 503 until models and galleries are loaded.
+    """
+
+    log_name = 'Frame ingest'
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/ready':
+            return self.send_json(404, {'error': 'Not found'})
+        state = self.server.startup_state()
+        self.send_json(200 if state['ready'] else 503, state)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/frames':
+            return self.send_json(404, {'error': 'Not found'})
+        if not self.server.startup_state()['ready']:
+            return self.send_json(503, {'error': 'Service is starting'}, close=True)
+        try:
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            length = int(self.headers.get('Content-Length', 0))
+            if length <= 0 or length > Config.INGEST_MAX_BYTES:
+                return self.send_json(413 if length > 0 else 400, {'error': f"Frame size {length} bytes not accepted"}, close=True)
+            jpeg_bytes = self.rfile.read(length)
+            camera_id = int(params.get('camera_id', self.headers.get('X-Camera-Id', 1)))
+            timestamp = parse_frame_timestamp(params.get('timestamp', self.headers.get('X-Timestamp')))
+        except Exception as e:
+            return self.send_json(400, {'error': f"Invalid request: {e}"}, close=True)
+
+        depth = self.server.queue_depth()
+        if depth >= Config.INGEST_MAX_QUEUE:
+            Config.logger.warning("Processing queue is full (%s items); rejecting frame from camera %s", depth, camera_id)
+            return self.send_json(503, {'error': 'Processing queue is full', 'queue_depth': depth})
+
+        self.server.enqueue_image(Frame(jpeg_bytes, camera_id, timestamp))
+        self.send_json(202, {'queued': True, 'queue_depth': depth + 1})
+
+
+def start_frame_ingest(enqueue_image, queue_depth, startup_state):
+    """Serve the ingestion endpoint on INGEST_SOCKET, or INGEST_HOST:INGEST_PORT if unset."""
+    if Config.INGEST_SOCKET:
+        server = UnixHTTPServer(Config.INGEST_SOCKET, FrameIngestHandler)
+        address = Config.INGEST_SOCKET
+    else:
+        server = ThreadingHTTPServer((Config.INGEST_HOST, Config.INGEST_PORT), FrameIngestHandler)
+        address = f"http://{Config.INGEST_HOST}:{server.server_address[1]}"
+    server.enqueue_image = enqueue_image
+    server.queue_depth = queue_depth
+    server.startup_state = startup_state
+    threading.Thread(target=server.serve_forever, daemon=True, name="frame-ingest").start()
+    Config.logger.info("Frame ingestion endpoint listening on %s/frames", address)
+    return server
@@ -16,7 +16,7 @@ def extract_date_from_filename(filename):
         date_str = filename.split("_")[2]
         return datetime.strptime(date_str, "%Y%m%d%H%M%S%f")
     except Exception as e:
-        Config.logger.error(f"Error extracting date from filename: {e}")
+        Config.logger.error("Error extracting date from filename: %s", e)
         return None
 
 def get_faces_data(faces, min_confidence=0.6):
@@ -29,6 +29,63 @@ def get_faces_data(faces, min_confidence=0.6):
     # Return the face with the highest detection score
     return max(faces, key=lambda face: face.det_score)
 
+def get_all_faces_data(faces, min_confidence=0.6):
+    """Select every face above the minimum confidence, highest detection score first."""
+    if not faces:
+        return []
+    faces = [face for face in faces if face.det_score >= min_confidence]
+    return sorted(faces, key=lambda face: face.det_score, reverse=True)
+
+def aggregate_template_scores(person_ids, similarities):
+    """Collapse top-k template hits into the best (person_id, score), aggregating each person's templates."""
+    scores = {}
+    for person_id, similarity in zip(person_ids, similarities):
+        if person_id == -1:
+            continue
+        scores.setdefault(int(person_id), []).append(float(similarity))
+    if not scores:
+        return None, 0
+    if Config.TEMPLATE_AGGREGATION == 'mean':
+        aggregated = {person_id: sum(sims) / len(sims) for person_id, sims in scores.items()}
+    else:
+        aggregated = {person_id: max(sims) for person_id, sims in scores.items()}
+    best_id = max(aggregated, key=aggregated.get)
+    return best_id, aggregated[best_id]
+
+def compact_templates(templates, max_count):
+    """Merge the most similar pair of templates into their centroid until at most max_count remain."""
+    templates = np.asarray(templates, dtype='float32')
+    if max_count <= 0:
+        return templates[:0]
+    while len(templates) > max_count:
+        similarities = templates @ templates.T
+        np.fill_diagonal(similarities, -np.inf)
+        i, j = np.unravel_index(np.argmax(similarities), similarities.shape)
+        centroid = templates[i] + templates[j]
+        centroid /= np.linalg.norm(centroid)
+        templates = np.vstack([np.delete(templates, [i, j], axis=0), centroid])
+    return templates
+
+def encode_upload_image(image, bbox=None):
+    """Encode a decoded BGR image for upload: crop to the face (mode 'face'), downscale to UPLOAD_MAX_SIZE, re-encode as JPEG."""
+    if Config.UPLOAD_IMAGE_MODE == 'face' and bbox is not None:
+        x1, y1, x2, y2 = bbox[:4]
+        margin_x = (x2 - x1) * Config.UPLOAD_CROP_MARGIN
+        margin_y = (y2 - y1) * Config.UPLOAD_CROP_MARGIN
+        height, width = image.shape[:2]
+        image = image[
+            max(int(y1 - margin_y), 0):min(int(y2 + margin_y), height),
+            max(int(x1 - margin_x), 0):min(int(x2 + margin_x), width)
+        ]
+    longest = max(image.shape[:2])
+    if Config.UPLOAD_MAX_SIZE and longest > Config.UPLOAD_MAX_SIZE:
+        scale = Config.UPLOAD_MAX_SIZE / longest
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    ok, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, Config.UPLOAD_JPEG_QUALITY])
+    if not ok:
+        raise ValueError("Failed to encode upload image")
+    return buffer.tobytes()
+
 def get_embedding_from_url(image_url, face_processor):
     try:
         headers = {'Authorization': f'Bearer {Config.API_TOKEN}'}
@@ -37,17 +94,17 @@ def get_embedding_from_url(image_url, face_processor):
         image_array = np.frombuffer(response.content, np.uint8)
         image = cv2.imdecode(image_array, cv2.IMREAD_COLOR)
         if image is None:
-            Config.logger.error(f"Failed to decode image from URL: {image_url}")
+            Config.logger.error("Failed to decode image from URL: %s", image_url)
             return None
         image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
         # image_resized = cv2.resize(image_rgb, Config.DET_SIZE)
         embedding, age, gender = face_processor.get_embedding_from_image(image_rgb)
         if embedding is None:
-            Config.logger.warning(f"No faces detected or pose exceeds threshold in image from URL: {image_url}")
+            Config.logger.warning("No faces detected or pose exceeds threshold in image from URL: %s", image_url)
             return None
         return embedding
     except Exception as e:
-        Config.logger.error(f"Error fetching or processing image from URL {image_url}: {e}")
+        Config.logger.error("Error fetching or processing image from URL %s: %s", image_url, e)
         return None
 
 def compute_sim(feat1, feat2, logger=Config.logger):
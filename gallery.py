@@ -0,0 +1,471 @@
+# gallery.py
+
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+import faiss
+from config import Config
+
+# Minimum number of vectors needed to train each storage codec; smaller galleries fall back to float16
+CODEC_MIN_TRAIN_SIZE = {
+    'int8': 1000,
+    'pq': 256 * 39,  # 39 points per k-means centroid, as faiss recommends
+}
+
+# IndexPQ cannot skip dead rows during a search, so it over-fetches by their count; rewrite past this
+PQ_MAX_DEAD_ROWS = 256
+
+
+def create_codec(storage, dimensions):
+    """Return an empty faiss flat-codes index for the storage mode: float32, float16, int8 or pq."""
+    if storage == 'float16':
+        return faiss.IndexScalarQuantizer(dimensions, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+    if storage == 'int8':
+        return faiss.IndexScalarQuantizer(dimensions, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+    if storage == 'pq':
+        return faiss.IndexPQ(dimensions, Config.PQ_SUBQUANTIZERS, 8, faiss.METRIC_INNER_PRODUCT)
+    return faiss.IndexFlatIP(dimensions)
+
+
+class GallerySegment:
+    """Immutable block of gallery rows: the person id of every row and their codes in one flat-codes index.
+
+    The codes live once, inside the index, as one contiguous row-per-template array.
+    """
+
+    def __init__(self, segment_id, ids, codec, codes):
+        self.id = segment_id
+        self.ids = ids  # Person id of every row
+        self.index = faiss.clone_index(codec)
+        if len(ids):
+            faiss.copy_array_to_vector(np.ascontiguousarray(codes).ravel(), self.index.codes)
+            self.index.ntotal = len(ids)
+            # View the index's own storage instead of holding a second copy of the codes
+            codes = faiss.rev_swig_ptr(self.index.codes.data(), codes.size).reshape(codes.shape)
+        self.codes = codes
+
+        # Sorted view of the ids so a person's rows can be found without a dict
+        self.order = np.argsort(ids, kind='stable')
+        self.sorted_ids = ids[self.order]
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.ids.nbytes + self.order.nbytes + self.sorted_ids.nbytes
+
+    def rows_of(self, person_ids):
+        """Return the sorted rows holding any of the given people."""
+        person_ids = np.asarray(person_ids, dtype='int64')
+        lo = np.searchsorted(self.sorted_ids, person_ids, side='left')
+        hi = np.searchsorted(self.sorted_ids, person_ids, side='right')
+        ranges = [self.order[a:b] for a, b in zip(lo, hi) if b > a]
+        if not ranges:
+            return np.zeros(0, dtype='int64')
+        return np.sort(np.concatenate(ranges))
+
+
+class SegmentState:
+    """A segment as seen by one snapshot: the segment plus the rows that snapshot treats as deleted."""
+
+    def __init__(self, segment, dead=None):
+        self.segment = segment
+        self.dead = np.zeros(0, dtype='int64') if dead is None else dead  # Sorted dead rows
+        self.live = len(segment) - len(self.dead)
+        self.params = None
+        if len(self.dead) and not isinstance(segment.index, faiss.IndexPQ):
+            # Let faiss skip dead rows; IndexPQ has no selector support and over-fetches instead
+            alive = np.ones(len(segment), dtype=bool)
+            alive[self.dead] = False
+            self.bitmap = np.packbits(alive, bitorder='little')
+            self.params = faiss.SearchParameters(sel=faiss.IDSelectorBitmap(len(segment), faiss.swig_ptr(self.bitmap)))
+
+    def with_dead(self, rows):
+        """Return this segment's state with more rows marked dead; unchanged states are shared."""
+        if len(rows) == 0:
+            return self
+        return SegmentState(self.segment, np.union1d(self.dead, rows))
+
+    def live_rows(self):
+        if len(self.dead) == 0:
+            return np.arange(len(self.segment))
+        return np.setdiff1d(np.arange(len(self.segment)), self.dead, assume_unique=True)
+
+    def search(self, queries, k):
+        segment = self.segment
+        if self.params is not None:
+            similarities, rows = segment.index.search(queries, min(k, self.live), params=self.params)
+        else:
+            similarities, rows = segment.index.search(queries, min(k + len(self.dead), len(segment)))
+            if len(self.dead):
+                rows = np.where(np.isin(rows, self.dead), -1, rows)
+        similarities = np.where(rows >= 0, similarities, -np.inf).astype('float32')
+        return similarities, np.where(rows >= 0, segment.ids[rows], -1)
+
+    def range_search(self, queries, threshold):
+        segment = self.segment
+        lims, similarities, rows = segment.index.range_search(queries, threshold)
+        query_rows = np.repeat(np.arange(len(queries)), np.diff(lims).astype('int64'))
+        if len(self.dead):
+            keep = ~np.isin(rows, self.dead)
+            query_rows, similarities, rows = query_rows[keep], similarities[keep], rows[keep]
+        return query_rows, similarities, segment.ids[rows]
+
+
+class GallerySnapshot:
+    """Immutable view of one gallery for lock-free readers.
+
+    A snapshot is a short list of immutable segments plus, per segment, the rows it
+    treats as deleted. Publishing appends changed people as a new small segment and
+    marks their old rows dead, so unchanged rows are shared with the previous snapshot
+    instead of copied. Small segments are merged as they accumulate (see Gallery.publish).
+    """
+
+    def __init__(self, states, codec, version, people):
+        self.states = states
+        self.version = version
+        self.codec = codec  # Empty trained index that encodes and decodes the rows
+        self.compressed = not isinstance(codec, faiss.IndexFlat)
+        self.people = people
+
+    def __len__(self):
+        return sum(state.live for state in self.states)
+
+    @property
+    def dead_rows(self):
+        return sum(len(state.dead) for state in self.states)
+
+    @property
+    def nbytes(self):
+        return sum(state.segment.nbytes + state.dead.nbytes for state in self.states)
+
+    def person_ids(self):
+        live = [state.segment.ids[state.live_rows()] for state in self.states]
+        return np.unique(np.concatenate(live)) if live else np.zeros(0, dtype='int64')
+
+    def get(self, person_id):
+        """Return the decoded templates of one person, or None if the snapshot does not hold them."""
+        templates = []
+        for state in self.states:
+            rows = state.segment.rows_of([person_id])
+            if len(state.dead):
+                rows = np.setdiff1d(rows, state.dead, assume_unique=True)
+            if len(rows):
+                templates.append(self.codec.sa_decode(state.segment.codes[rows]))
+        return np.vstack(templates) if templates else None
+
+    def search(self, queries, k):
+        """Return (similarities, person_ids) of the k best rows per query; missing hits have id -1.
+
+        Compressed codecs score each row as the inner product with its decoded template.
+        """
+        results = [state.search(queries, k) for state in self.states if state.live]
+        if not results:
+            return np.zeros((len(queries), 0), dtype='float32'), np.zeros((len(queries), 0), dtype='int64')
+        if len(results) == 1 and results[0][0].shape[1] <= k:
+            return results[0]
+        similarities = np.hstack([r[0] for r in results])
+        person_ids = np.hstack([r[1] for r in results])
+        best = np.argsort(-similarities, axis=1, kind='stable')[:, :min(k, len(self))]
+        return np.take_along_axis(similarities, best, axis=1), np.take_along_axis(person_ids, best, axis=1)
+
+    def range_search(self, queries, threshold):
+        """Return (lims, similarities, person_ids) of every row above the threshold, as faiss range_search does."""
+        results = [state.range_search(queries, threshold) for state in self.states if state.live]
+        if not results:
+            return np.zeros(len(queries) + 1, dtype='int64'), np.zeros(0, dtype='float32'), np.zeros(0, dtype='int64')
+        query_rows = np.concatenate([r[0] for r in results])
+        order = np.argsort(query_rows, kind='stable')
+        lims = np.searchsorted(query_rows[order], np.arange(len(queries) + 1))
+        similarities = np.concatenate([r[1] for r in results])[order]
+        person_ids = np.concatenate([r[2] for r in results])[order]
+        return lims, similarities, person_ids
+
+
+class Gallery:
+    """Pending writes of one person type plus the snapshot readers search.
+
+    Mutations record the person's new templates (or their removal) in the pending map
+    under the write lock. A background publisher folds pending people into a new
+    snapshot after a short batching window, so a bulk sync publishes a handful of
+    snapshots rather than one per person. Everything else is read back from the snapshot.
+    """
+
+    def __init__(self, label, dimensions):
+        self.label = label
+        self.dimensions = dimensions
+        self.storage = Config.GALLERY_STORAGE
+        self.codec = create_codec('float32', dimensions)
+        self.codec_storage = 'float32'  # Storage mode of self.codec; float16 while too small to train self.storage
+        self.pending = {}  # person_id -> templates, or None for a removal, not yet published
+        self.publishing = {}  # Pending entries taken by the publish in progress
+        self.lock = threading.Lock()
+        self.publish_lock = threading.Lock()
+        self.next_segment_id = 0
+        self.snapshot = GallerySnapshot([], self.codec, 0, 0)
+
+        # Contention and publish metrics
+        self.lock_acquisitions = 0
+        self.lock_wait_seconds = 0.0
+        self.max_lock_wait_seconds = 0.0
+        self.publishes = 0
+        self.publish_seconds = 0.0
+        self.max_publish_seconds = 0.0
+        self.searches = 0
+
+        self.listeners = []  # Called with every new snapshot; must return quickly
+        self.publish_requested = threading.Event()
+        threading.Thread(target=self.publisher, daemon=True, name=f"{label.lower()}-gallery-publisher").start()
+
+    @contextmanager
+    def write(self):
+        """Hold the write lock, recording how long the writer waited for it."""
+        started = time.perf_counter()
+        with self.lock:
+            waited = time.perf_counter() - started
+            self.lock_acquisitions += 1
+            self.lock_wait_seconds += waited
+            self.max_lock_wait_seconds = max(self.max_lock_wait_seconds, waited)
+            yield
+        self.publish_requested.set()
+
+    def get(self, person_id):
+        """Return a person's current templates. Call while holding write() or the lock."""
+        for changes in (self.pending, self.publishing):
+            if person_id in changes:
+                return changes[person_id]
+        return self.snapshot.get(person_id)
+
+    def set_templates(self, person_id, templates):
+        """Replace a person's templates. Call while holding write()."""
+        self.pending[person_id] = np.asarray(templates, dtype='float32')
+
+    def remove(self, person_id):
+        """Drop a person. Call while holding write()."""
+        self.pending[person_id] = None
+
+    def get_templates(self, person_ids):
+        """Return {person_id: templates} for the given people that exist."""
+        with self.lock:
+            templates = {pid: self.get(pid) for pid in person_ids}
+        return {pid: t for pid, t in templates.items() if t is not None}
+
+    def person_ids(self):
+        with self.lock:
+            changes = {**self.publishing, **self.pending}
+            snapshot = self.snapshot
+        ids = set(snapshot.person_ids().tolist())
+        ids.update(pid for pid, templates in changes.items() if templates is not None)
+        ids.difference_update(pid for pid, templates in changes.items() if templates is None)
+        return list(ids)
+
+    def reset(self, templates):
+        """Replace the whole gallery and publish it immediately, retraining the storage codec."""
+        with self.publish_lock:
+            started = time.perf_counter()
+            with self.write():
+                self.pending = {}
+            ids, matrix = self._stack(templates)
+            self.codec = self._train_codec(matrix)
+            states = [SegmentState(self._segment(ids, self._encode(matrix)))] if len(ids) else []
+            snapshot = GallerySnapshot(states, self.codec, self.snapshot.version + 1, len(templates))
+            self._swap(snapshot, started)
+            self.report_compression(matrix, snapshot)
+
+    def _train_codec(self, matrix):
+        storage = self.storage
+        if len(matrix) < CODEC_MIN_TRAIN_SIZE.get(storage, 0):
+            Config.logger.warning(
+                "%s gallery has %s templates, too few to train %s storage; using float16 until it grows.", self.label, len(matrix), storage
+            )
+            storage = 'float16'
+        self.codec_storage = storage
+        codec = create_codec(storage, self.dimensions)
+        if not codec.is_trained:
+            sample = matrix
+            if len(matrix) > Config.CODEC_TRAIN_SIZE:
+                sample = matrix[np.random.default_rng(0).choice(len(matrix), Config.CODEC_TRAIN_SIZE, replace=False)]
+            codec.train(sample)
+        return codec
+
+    def needs_retrain(self):
+        """True once a gallery stored as float16 for lack of training data has grown enough to train its storage codec."""
+        return self.codec_storage != self.storage and len(self.snapshot) >= CODEC_MIN_TRAIN_SIZE.get(self.storage, 0)
+
+    def retrain(self):
+        """Retrain the storage codec on the live templates and republish them as a single segment."""
+        with self.publish_lock:
+            if not self.needs_retrain():
+                return  # Another publisher thread got here first
+            started = time.perf_counter()
+            old = self.snapshot
+            live = [(state, state.live_rows()) for state in old.states if state.live]
+            ids = np.concatenate([state.segment.ids[rows] for state, rows in live])
+            matrix = np.vstack([old.codec.sa_decode(state.segment.codes[rows]) for state, rows in live])
+            self.codec = self._train_codec(matrix)
+            snapshot = GallerySnapshot([SegmentState(self._segment(ids, self._encode(matrix)))], self.codec, old.version + 1, old.people)
+            with self.lock:
+                self._swap(snapshot, started)
+            Config.logger.info("%s gallery retrained as %s storage at %s templates.", self.label, self.codec_storage, len(ids))
+            self.report_compression(matrix, snapshot)
+
+    def _encode(self, matrix):
+        if len(matrix) == 0:
+            return np.zeros((0, self.codec.code_size), dtype='uint8')
+        return self.codec.sa_encode(matrix)
+
+    def report_compression(self, matrix, snapshot):
+        """Log memory saved against a float32 store and the recall@k lost to compression."""
+        if len(matrix) == 0 or not snapshot.compressed:
+            return
+        ids = snapshot.states[0].segment.ids
+        float32_bytes = matrix.nbytes + 2 * ids.nbytes
+        k = min(Config.TEMPLATE_SEARCH_K, len(matrix))
+        sample = np.random.default_rng(0).choice(len(matrix), min(Config.RECALL_SAMPLE_SIZE, len(matrix)), replace=False)
+        queries = matrix[sample]
+        _, exact = faiss.knn(queries, matrix, k, metric=faiss.METRIC_INNER_PRODUCT)
+        _, approx = snapshot.search(queries, k)
+        recall = np.mean([
+            len(set(ids[e].tolist()) & set(a.tolist())) / len(set(ids[e].tolist()))
+            for e, a in zip(exact, approx)
+        ])
+        Config.logger.info(
+            "%s gallery stored as %s (%s bytes/template): %.1f MiB instead of %.1f MiB, recall@%s %.4f on %s sampled templates",
+            self.label, type(self.codec).__name__, self.codec.code_size, snapshot.nbytes / 2**20, float32_bytes / 2**20,
+            k, recall, len(sample)
+        )
+
+    def search(self, queries, k):
+        self.searches += 1
+        return self.snapshot.search(queries, k)
+
+    def range_search(self, queries, threshold):
+        return self.snapshot.range_search(queries, threshold)
+
+    def publisher(self):
+        next_metrics = time.monotonic() + Config.GALLERY_METRICS_INTERVAL_SECONDS
+        while True:
+            if self.publish_requested.wait(timeout=max(next_metrics - time.monotonic(), 0)):
+                time.sleep(Config.SNAPSHOT_BATCH_WINDOW_SECONDS)  # Let a burst of writes land in one snapshot
+                self.publish_requested.clear()
+                try:
+                    self.publish()
+                    if self.needs_retrain():
+                        self.retrain()
+                except Exception as e:
+                    Config.logger.error("Error publishing %s gallery snapshot: %s", self.label, e)
+            # Log on a fixed schedule, however busy the publisher is
+            if time.monotonic() >= next_metrics:
+                self.log_metrics()
+                next_metrics = time.monotonic() + Config.GALLERY_METRICS_INTERVAL_SECONDS
+
+    def publish(self):
+        """Fold every pending person into a new snapshot and swap it in."""
+        with self.publish_lock:
+            started = time.perf_counter()
+            with self.lock:
+                if not self.pending:
+                    return self.snapshot
+                self.publishing = self.pending
+                self.pending = {}
+                changes = self.publishing
+
+            # Build outside the write lock; readers keep using the old snapshot meanwhile.
+            # Old rows of changed people are only marked dead and their new templates go into
+            # a new segment, so unchanged rows are neither copied nor re-quantized.
+            old = self.snapshot
+            changed = np.fromiter(changes, dtype='int64', count=len(changes))
+            states, existing = [], set()
+            for state in old.states:
+                rows = np.setdiff1d(state.segment.rows_of(changed), state.dead, assume_unique=True)
+                existing.update(state.segment.ids[rows].tolist())
+                states.append(state.with_dead(rows))
+            added = {pid: t for pid, t in changes.items() if t is not None}
+            new_ids, new_matrix = self._stack(added)
+            if len(new_ids):
+                states.append(SegmentState(self._segment(new_ids, self._encode(new_matrix))))
+            people = old.people - len(existing) + len(added)
+            snapshot = GallerySnapshot(self._merge(states), self.codec, old.version + 1, people)
+            with self.lock:
+                self._swap(snapshot, started)
+                self.publishing = {}
+            return snapshot
+
+    def _segment(self, ids, codes):
+        self.next_segment_id += 1
+        return GallerySegment(self.next_segment_id, ids, self.codec, codes)
+
+    def _combine(self, states):
+        """Copy the live rows of the given segment states into one new segment."""
+        live = [state.live_rows() for state in states]
+        ids = np.concatenate([state.segment.ids[rows] for state, rows in zip(states, live)])
+        codes = np.vstack([state.segment.codes[rows] for state, rows in zip(states, live)])
+        return SegmentState(self._segment(ids, codes))
+
+    def _merge(self, states):
+        """Keep the segment list short and the dead rows few.
+
+        The newest segment is merged into the one before it while that one is at most
+        twice its size, so segment sizes grow geometrically: there are O(log n) segments
+        and each row is copied O(log n) times over its life, not once per publish.
+        Segments whose dead rows pass GALLERY_MAX_DEAD_FRACTION are rewritten on their own.
+        """
+        states = [state for state in states if state.live]
+        while len(states) > 1 and states[-2].live <= 2 * states[-1].live:
+            states = states[:-2] + [self._combine(states[-2:])]
+        for i, state in enumerate(states):
+            too_many_dead = len(state.dead) > Config.GALLERY_MAX_DEAD_FRACTION * len(state.segment)
+            if isinstance(state.segment.index, faiss.IndexPQ):
+                too_many_dead = too_many_dead or len(state.dead) > PQ_MAX_DEAD_ROWS
+            if too_many_dead:
+                states[i] = self._combine([state])
+        return states
+
+    def _swap(self, snapshot, started):
+        self.snapshot = snapshot  # Atomic reference swap; in-flight searches finish on the old snapshot
+        elapsed = time.perf_counter() - started
+        self.publishes += 1
+        self.publish_seconds += elapsed
+        self.max_publish_seconds = max(self.max_publish_seconds, elapsed)
+        Config.logger.debug(
+            "Published %s snapshot v%s with %s templates in %.1f ms", self.label, snapshot.version, len(snapshot), elapsed * 1000
+        )
+        for listener in self.listeners:
+            listener(self, snapshot)
+        return snapshot
+
+    def _stack(self, templates):
+        if not templates:
+            return np.zeros(0, dtype='int64'), np.zeros((0, self.dimensions), dtype='float32')
+        ids = np.concatenate([np.full(len(t), pid, dtype='int64') for pid, t in templates.items()])
+        matrix = np.vstack(list(templates.values())).astype('float32')
+        return ids, matrix
+
+    def metrics(self):
+        snapshot = self.snapshot
+        return {
+            'version': snapshot.version,
+            'people': snapshot.people,
+            'templates': len(snapshot),
+            'memory_mb': snapshot.nbytes / 2**20,
+            'segments': len(snapshot.states),
+            'dead_rows': snapshot.dead_rows,
+            'searches': self.searches,
+            'lock_acquisitions': self.lock_acquisitions,
+            'avg_lock_wait_ms': 1000 * self.lock_wait_seconds / max(self.lock_acquisitions, 1),
+            'max_lock_wait_ms': 1000 * self.max_lock_wait_seconds,
+            'publishes': self.publishes,
+            'avg_publish_ms': 1000 * self.publish_seconds / max(self.publishes, 1),
+            'max_publish_ms': 1000 * self.max_publish_seconds,
+        }
+
+    def log_metrics(self):
+        m = self.metrics()
+        Config.logger.info(
+            "%s gallery v%s: %s people, %s templates in %s segments (%s dead rows), %.1f MiB, %s searches, "
+            "write lock wait avg %.2f ms / max %.2f ms, publish avg %.1f ms / max %.1f ms over %s publishes",
+            self.label, m['version'], m['people'], m['templates'], m['segments'], m['dead_rows'], m['memory_mb'], m['searches'],
+            m['avg_lock_wait_ms'], m['max_lock_wait_ms'], m['avg_publish_ms'], m['max_publish_ms'], m['publishes']
+        )
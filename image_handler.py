@@ -4,96 +4,48 @@ import os
 import time
 
 import cv2
+import numpy as np
 import threading
 from watchdog.events import FileSystemEventHandler
 from datetime import datetime
 from config import Config
-from api_handler import save_attendance_to_api, update_client_via_api, create_client_via_api
+from api_handler import ReportImage, save_attendance_to_api, update_client_via_api, create_client_via_api
 from funcs import extract_date_from_filename
+from tracing import span, annotate, attach_input, mark
 
-def process_image(file_path, camera_id, db_manager, face_processor, employee_last_report_times, client_last_report_times, lock):
-    Config.logger.info(f"Processing image: {file_path} from camera_id: {camera_id}")
-    try:
-        image = cv2.imread(file_path)
-        if image is None:
-            Config.logger.error(f"Failed to read image from {file_path}")
-            return
-
-        image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        # image_resized = cv2.resize(image_rgb, Config.DET_SIZE)
-
-        embedding, age, gender = face_processor.get_embedding_from_image(image_rgb)
-        if embedding is None:
-            Config.logger.error(f"No face embedding found in image: {file_path}")
-            return
+class Frame:
+    """A camera frame received in memory by the ingestion endpoint; it never touches the disk."""
 
-        # Set default age and gender if not detected
-        age = int(round(age)) if age is not None else Config.DEFAULT_AGE
-        gender = int(round(gender)) if gender is not None else Config.DEFAULT_GENDER
+    def __init__(self, jpeg_bytes, camera_id, timestamp):
+        self.jpeg_bytes = jpeg_bytes
+        self.camera_id = camera_id
+        self.timestamp = timestamp
+        self.filename = f"camera_{camera_id}_{timestamp.strftime('%Y%m%d%H%M%S%f')}_SNAP.jpg"
 
+def process_image(file_path, camera_id, db_manager, face_processor, employee_last_report_times, client_last_report_times, lock):
+    Config.logger.info("Processing image: %s from camera_id: %s", file_path, camera_id)
+    try:
         timestamp = extract_date_from_filename(os.path.basename(file_path))
         if not timestamp:
-            Config.logger.error(f"Could not extract date from filename: {file_path}")
+            Config.logger.error("Could not extract date from filename: %s", file_path)
             return
 
-        # Search for matching employee
-        employee, similarity_emp = db_manager.find_matching_employee(embedding)
-        if employee:
-            person_id = employee['person_id']
-            with lock:
-                last_report_time = employee_last_report_times.get(person_id)
-                current_time = datetime.now()
-                if last_report_time and (current_time - last_report_time).total_seconds() < Config.REPORT_COOLDOWN_SECONDS:
-                    Config.logger.info(f"Employee {person_id} was seen recently. Skipping attendance report.")
-                    return
-                else:
-                    save_attendance_to_api(
-                        person_id=employee['person_id'],
-                        device_id=camera_id,
-                        image_path=file_path,
-                        timestamp=timestamp.strftime("%Y-%m-%d %H:%M:%S"),
-                        score=similarity_emp
-                    )
-                    employee_last_report_times[person_id] = current_time
-                    return
-
-        # Search for matching client
-        client, similarity_cli = db_manager.find_matching_client(embedding)
-        if client:
-            person_id = client['person_id']
-            with lock:
-                last_report_time = client_last_report_times.get(person_id)
-                current_time = datetime.now()
-                if last_report_time and (current_time - last_report_time).total_seconds() < Config.REPORT_COOLDOWN_SECONDS:
-                    Config.logger.info(f"Client {person_id} was seen recently. Skipping visit history update.")
-                    return
-                else:
-                    update_client_via_api(
-                        client_id=person_id,
-                        datetime_str=timestamp.strftime("%Y-%m-%d %H:%M:%S"),
-                        device_id=camera_id
-                    )
-                    client_last_report_times[person_id] = current_time
-                    Config.logger.info(f"Client {person_id} visited with similarity {similarity_cli}")
+        # Read the file once; reports upload these bytes or a re-encoding of the decoded frame
+        with span('read'):
+            with open(file_path, 'rb') as img_file:
+                jpeg_bytes = img_file.read()
+            image = cv2.imdecode(np.frombuffer(jpeg_bytes, np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            Config.logger.error("Failed to read image from %s", file_path)
             return
 
-        # If no match found, create new client
-        new_client_id = create_client_via_api(
-            image_path=file_path,
-            first_seen=timestamp.strftime("%Y-%m-%d %H:%M:%S"),
-            last_seen=timestamp.strftime("%Y-%m-%d %H:%M:%S"),
-            gender=gender,
-            age=age
+        analyse_image(
+            image, jpeg_bytes, os.path.basename(file_path), camera_id, timestamp,
+            db_manager, face_processor, employee_last_report_times, client_last_report_times, lock
         )
 
-        if new_client_id:
-            # Store the embedding in MongoDB
-            db_manager.add_client_embedding(new_client_id, embedding)
-        else:
-            Config.logger.error("Failed to create new client")
-
     except Exception as e:
-        Config.logger.error(f"Error processing image {file_path}: {e}")
+        Config.logger.error("Error processing image %s: %s", file_path, e)
     finally:
         # Clean up the processed file
         if os.path.exists(file_path):
@@ -103,6 +55,122 @@ def process_image(file_path, camera_id, db_manager, face_processor, employee_las
         if os.path.exists(bg_file):
             os.remove(bg_file)
 
+def process_frame(frame, db_manager, face_processor, employee_last_report_times, client_last_report_times, lock):
+    Config.logger.info("Processing in-memory frame: %s from camera_id: %s", frame.filename, frame.camera_id)
+    try:
+        with span('decode'):
+            image = cv2.imdecode(np.frombuffer(frame.jpeg_bytes, np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            Config.logger.error("Failed to decode frame %s", frame.filename)
+            return
+
+        analyse_image(
+            image, frame.jpeg_bytes, frame.filename, frame.camera_id, frame.timestamp,
+            db_manager, face_processor, employee_last_report_times, client_last_report_times, lock
+        )
+
+    except Exception as e:
+        Config.logger.error("Error processing frame %s: %s", frame.filename, e)
+
+def analyse_image(image, jpeg_bytes, name, camera_id, timestamp, db_manager, face_processor,
+                  employee_last_report_times, client_last_report_times, lock):
+    """Detect, match and report the faces of a decoded BGR image whose source JPEG is jpeg_bytes."""
+    attach_input(jpeg_bytes)
+    image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    # image_resized = cv2.resize(image_rgb, Config.DET_SIZE)
+
+    with span('detect_embed'):
+        if Config.PROCESS_ALL_FACES:
+            faces = face_processor.get_embeddings_from_image(image_rgb)
+        else:
+            embedding, age, gender, bbox = face_processor.get_best_face_from_image(image_rgb)
+            faces = [(embedding, age, gender, bbox)] if embedding is not None else []
+    annotate(camera_id=camera_id, width=image.shape[1], height=image.shape[0], faces=len(faces))
+    if not faces:
+        Config.logger.error("No face embedding found in image: %s", name)
+        return
+
+    embeddings = [face[0] for face in faces]
+
+    # Search for matching employees, then match the remaining faces against clients
+    employee_matches = db_manager.find_matching_employees(embeddings)
+    unmatched = [i for i, (employee, _) in enumerate(employee_matches) if not employee]
+    client_matches = dict(zip(unmatched, db_manager.find_matching_clients([embeddings[i] for i in unmatched])))
+
+    for i, (embedding, age, gender, bbox) in enumerate(faces):
+        employee, similarity_emp = employee_matches[i]
+        client, similarity_cli = client_matches.get(i, (None, 0))
+        with span('report', face=i):
+            report_face(
+                ReportImage(name, jpeg_bytes, image, bbox), camera_id, db_manager, timestamp, embedding, age, gender,
+                employee, similarity_emp, client, similarity_cli,
+                employee_last_report_times, client_last_report_times, lock
+            )
+
+def report_face(report_image, camera_id, db_manager, timestamp, embedding, age, gender,
+                employee, similarity_emp, client, similarity_cli,
+                employee_last_report_times, client_last_report_times, lock):
+    """Report a single face as an employee attendance, a client visit or a new client."""
+    # Set default age and gender if not detected
+    age = int(round(age)) if age is not None else Config.DEFAULT_AGE
+    gender = int(round(gender)) if gender is not None else Config.DEFAULT_GENDER
+
+    if employee:
+        person_id = employee['person_id']
+        with lock:
+            last_report_time = employee_last_report_times.get(person_id)
+            current_time = datetime.now()
+            if last_report_time and (current_time - last_report_time).total_seconds() < Config.REPORT_COOLDOWN_SECONDS:
+                Config.logger.info("Employee %s was seen recently. Skipping attendance report.", person_id)
+                return
+            else:
+                save_attendance_to_api(
+                    person_id=employee['person_id'],
+                    device_id=camera_id,
+                    image=report_image,
+                    timestamp=timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+                    score=similarity_emp
+                )
+                employee_last_report_times[person_id] = current_time
+                if similarity_emp >= Config.TEMPLATE_CAPTURE_THRESHOLD:
+                    db_manager.add_employee_template(person_id, embedding)
+                return
+
+    if client:
+        person_id = client['person_id']
+        with lock:
+            last_report_time = client_last_report_times.get(person_id)
+            current_time = datetime.now()
+            if last_report_time and (current_time - last_report_time).total_seconds() < Config.REPORT_COOLDOWN_SECONDS:
+                Config.logger.info("Client %s was seen recently. Skipping visit history update.", person_id)
+                return
+            else:
+                update_client_via_api(
+                    client_id=person_id,
+                    datetime_str=timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+                    device_id=camera_id
+                )
+                client_last_report_times[person_id] = current_time
+                Config.logger.info("Client %s visited with similarity %s", person_id, similarity_cli)
+                if similarity_cli >= Config.TEMPLATE_CAPTURE_THRESHOLD:
+                    db_manager.add_client_template(person_id, embedding)
+        return
+
+    # If no match found, create new client
+    new_client_id = create_client_via_api(
+        image=report_image,
+        first_seen=timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+        last_seen=timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+        gender=gender,
+        age=age
+    )
+
+    if new_client_id:
+        # Store the embedding in MongoDB
+        db_manager.add_client_embedding(new_client_id, embedding)
+    else:
+        Config.logger.error("Failed to create new client")
+
 # Image Handler for Watchdog
 class ImageHandler(FileSystemEventHandler):
     def __init__(self, camera_id, db_manager, face_processor, employee_last_report_times, client_last_report_times, lock, enqueue_image):
@@ -121,7 +189,7 @@ class ImageHandler(FileSystemEventHandler):
             return
         filename = os.path.basename(event.src_path)
         if filename.endswith('SNAP.jpg'):
-            Config.logger.info(f"New image detected: {event.src_path}")
+            Config.logger.info("New image detected: %s", event.src_path)
             self.schedule_processing(event.src_path)
 
     def on_modified(self, event):
@@ -129,10 +197,11 @@ class ImageHandler(FileSystemEventHandler):
             return
         filename = os.path.basename(event.src_path)
         if filename.endswith('SNAP.jpg'):
-            Config.logger.debug(f"Image modified: {event.src_path}")
+            Config.logger.debug("Image modified: %s", event.src_path)
             self.schedule_processing(event.src_path)
 
     def schedule_processing(self, file_path):
+        mark(file_path, 'detected')
         def delayed_process():
             try:
                 # Wait for the debounce delay
@@ -141,15 +210,15 @@ class ImageHandler(FileSystemEventHandler):
                 current_time = time.time()
                 last_modified = os.path.getmtime(file_path)
                 if current_time - last_modified >= self.debounce_delay:
-                    Config.logger.info(f"File {file_path} is ready for processing.")
+                    Config.logger.info("File %s is ready for processing.", file_path)
                     self.enqueue_image(file_path)
                     self.pending_files.pop(file_path, None)
                 else:
                     # Reschedule processing
-                    Config.logger.debug(f"Rescheduling processing for {file_path}")
+                    Config.logger.debug("Rescheduling processing for %s", file_path)
                     self.schedule_processing(file_path)
             except Exception as e:
-                Config.logger.error(f"Error in delayed_process for {file_path}: {e}")
+                Config.logger.error("Error in delayed_process for %s: %s", file_path, e)
                 self.pending_files.pop(file_path, None)
 
         # Cancel any existing timer for the file
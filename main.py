@@ -1,14 +1,21 @@
 # main.py
 import os
 import threading
+import multiprocessing
 import asyncio
 import time
+from concurrent.futures import ThreadPoolExecutor
 from config import Config
 from database_manager import DatabaseManager
 from face_processor import FaceProcessor
-from image_handler import process_image, ImageHandler
+from image_handler import process_image, process_frame, Frame, ImageHandler
 from data_fetcher import fetch_and_store_data
 from websocket_listener import websocket_listener
+from client_compactor import ClientCompactor
+from shared_gallery import SharedGalleryPublisher, apply_worker_writes, run_worker_process
+from search_service import start_search_service
+from frame_ingest import start_frame_ingest
+from tracing import trace_frame, mark
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from queue import Queue
@@ -27,7 +34,7 @@ from queue import Queue
 #             return
 #         filename = os.path.basename(event.src_path)
 #         if filename.endswith('SNAP.jpg'):
-#             Config.logger.info(f"New image detected: {event.src_path}")
+#             Config.logger.info("New image detected: %s", event.src_path)
 #             threading.Thread(
 #                 target=process_image,
 #                 args=(
@@ -42,77 +49,203 @@ from queue import Queue
 #                 daemon=True
 #             ).start()
 
+def timed_phase(name, func, *args):
+    """Run one startup phase and log how long it took."""
+    started = time.perf_counter()
+    result = func(*args)
+    Config.logger.info("Startup phase '%s' took %.2f s", name, time.perf_counter() - started)
+    return result
+
 class MainRunner:
     def __init__(self, images_folder):
+        started = time.perf_counter()
         self.images_folder = images_folder
-        self.db_manager = DatabaseManager()
-        self.face_processor = FaceProcessor()
         self.logger = Config.logger
         self.employee_last_report_times = {}
         self.client_last_report_times = {}
         self.lock = threading.Lock()
+        # ready: models and galleries are loaded; synced: the initial backend sync has finished
+        self.ready = threading.Event()
+        self.synced = threading.Event()
 
         self.loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self.loop)
 
         # Initialize a queue for image processing tasks
-        self.image_queue = Queue()
+        if Config.WORKER_PROCESSES > 0:
+            self.context = multiprocessing.get_context('spawn')
+            self.image_queue = self.context.Queue()
+            self.workers_ready = self.context.Value('i', 0)  # Worker processes done loading
+        else:
+            self.image_queue = Queue()
+
+        # Bind the ingestion endpoint right away; it refuses frames until the runner is ready
+        if Config.INGEST_ENABLED:
+            start_frame_ingest(self.enqueue_image, self.queue_depth, self.startup_state)
+
+        self.start_up()
+
+        if Config.WORKER_PROCESSES > 0:
+            self.start_worker_processes(Config.WORKER_PROCESSES)
+            # Worker processes load their own models; frames are accepted once one of them can take them
+            threading.Thread(target=self.wait_for_workers, args=(started,), daemon=True, name="worker-startup").start()
+        else:
+            # Start the worker thread
+            self.worker_thread = threading.Thread(target=self.image_processing_worker, daemon=True)
+            self.worker_thread.start()
+            self.set_ready(started)
+
+    def set_ready(self, started):
+        self.ready.set()
+        self.logger.info("Ready to process images %.2f s after start.", time.perf_counter() - started)
+
+    def wait_for_workers(self, started):
+        """Set ready once the first worker process has loaded its models and mapped the galleries."""
+        while self.workers_ready.value == 0:
+            if not any(process.is_alive() for process in self.worker_processes):
+                self.logger.error("Every worker process exited before becoming ready.")
+                return
+            time.sleep(0.1)
+        self.set_ready(started)
 
-        # Start the worker thread
-        self.worker_thread = threading.Thread(target=self.image_processing_worker, daemon=True)
-        self.worker_thread.start()
+    def start_up(self):
+        """Connect to Mongo and load the galleries while the face models load and warm up."""
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix="startup") as executor:
+            galleries = executor.submit(timed_phase, "Mongo connection and gallery load", DatabaseManager)
+            models = executor.submit(timed_phase, "Model load and warm-up", FaceProcessor)
+            self.db_manager = galleries.result()
+            self.face_processor = models.result()
+
+    def startup_state(self):
+        state = {'ready': self.ready.is_set(), 'synced': self.synced.is_set()}
+        if Config.WORKER_PROCESSES > 0:
+            state['workers_ready'] = self.workers_ready.value
+        return state
+
+    def start_worker_processes(self, count):
+        """Run inference in worker processes that map the gallery read-only from shared memory."""
+        context = self.context
+        write_queue = context.Queue()
+
+        # Cooldowns must be shared so two workers do not report the same person twice
+        self.manager = context.Manager()
+        self.employee_last_report_times = self.manager.dict()
+        self.client_last_report_times = self.manager.dict()
+        self.lock = self.manager.Lock()
+
+        self.gallery_publisher = SharedGalleryPublisher(
+            [self.db_manager.employee_gallery, self.db_manager.client_gallery], Config.SHARED_GALLERY_DIR, context
+        )
+        threading.Thread(target=apply_worker_writes, args=(self.db_manager, write_queue), daemon=True).start()
+
+        self.worker_processes = []
+        for _ in range(count):
+            process = context.Process(
+                target=run_worker_process,
+                args=(
+                    Config.SHARED_GALLERY_DIR,
+                    self.gallery_publisher.versions,
+                    self.image_queue,
+                    write_queue,
+                    self.employee_last_report_times,
+                    self.client_last_report_times,
+                    self.lock,
+                    self.workers_ready
+                ),
+                daemon=True
+            )
+            process.start()
+            self.worker_processes.append(process)
+        self.logger.info("Started %s worker processes sharing %s", count, Config.SHARED_GALLERY_DIR)
 
     def run(self):
-        self.logger.info(f"Starting image processing for: {self.images_folder}")
+        self.logger.info("Starting image processing for: %s", self.images_folder)
 
         test_camera_dir = os.path.join(self.images_folder, 'test_camera')
         os.makedirs(test_camera_dir, exist_ok=True)
 
-        # Start the periodic fetch_and_store_data in a separate thread
-        fetch_and_store_data(self.db_manager, self.face_processor)
+        # Sync with the backend in the background; frames are matched against the stored galleries meanwhile
+        threading.Thread(target=self.initial_sync, daemon=True, name="initial-sync").start()
 
         # Start the WebSocket listener in a separate thread
         ws_thread = threading.Thread(target=self.start_websocket_listener, daemon=True)
         self.logger.info("Starting WebSocket listener.")
         ws_thread.start()
 
+        # Let local tools query the loaded gallery
+        if Config.SEARCH_SERVICE_ENABLED:
+            start_search_service({
+                'employee': self.db_manager.employee_gallery,
+                'client': self.db_manager.client_gallery,
+            })
+
+        # Start the client deduplication job in the background
+        if Config.CLIENT_COMPACTION_INTERVAL_SECONDS > 0:
+            compactor = ClientCompactor(self.db_manager)
+            threading.Thread(target=compactor.run, daemon=True).start()
+            self.logger.info("Started client compaction job.")
+
         # Process existing images in the directory by adding them to the queue
         self.process_images_in_directory(test_camera_dir)
 
         # Now start the watchdog to monitor new images
         self.start_watchdog(test_camera_dir)
 
+    def initial_sync(self):
+        timed_phase("Initial backend sync", fetch_and_store_data, self.db_manager, self.face_processor)
+        self.synced.set()
+
     def image_processing_worker(self):
         while True:
             try:
                 # Get the next image path from the queue
-                file_path = self.image_queue.get()
-                if file_path is None:
+                item = self.image_queue.get()
+                if item is None:
                     # Sentinel value to stop the worker
                     break
-                self.logger.info(f"Worker processing image: {file_path}")
-                process_image(
-                    file_path,
-                    1,  # camera_id
-                    self.db_manager,
-                    self.face_processor,
-                    self.employee_last_report_times,
-                    self.client_last_report_times,
-                    self.lock
-                )
+                with trace_frame(item.filename if isinstance(item, Frame) else item):
+                    if isinstance(item, Frame):
+                        process_frame(
+                            item,
+                            self.db_manager,
+                            self.face_processor,
+                            self.employee_last_report_times,
+                            self.client_last_report_times,
+                            self.lock
+                        )
+                    else:
+                        self.logger.info("Worker processing image: %s", item)
+                        process_image(
+                            item,
+                            1,  # camera_id
+                            self.db_manager,
+                            self.face_processor,
+                            self.employee_last_report_times,
+                            self.client_last_report_times,
+                            self.lock
+                        )
                 self.image_queue.task_done()
             except Exception as e:
-                self.logger.error(f"Error in image_processing_worker: {e}")
+                self.logger.error("Error in image_processing_worker: %s", e)
 
-    def enqueue_image(self, file_path):
-        self.image_queue.put(file_path)
+    def enqueue_image(self, item):
+        """Queue a SNAP file path or an in-memory Frame for processing."""
+        mark(item.filename if isinstance(item, Frame) else item, 'enqueued')
+        self.image_queue.put(item)
+
+    def queue_depth(self):
+        try:
+            return self.image_queue.qsize()
+        except NotImplementedError:
+            # multiprocessing queues cannot report their size on some platforms
+            return 0
 
     def process_images_in_directory(self, directory):
         # List all files ending with 'SNAP.jpg' in the directory
         for filename in os.listdir(directory):
             if filename.endswith('SNAP.jpg'):
                 file_path = os.path.join(directory, filename)
-                self.logger.info(f"Found image to process: {file_path}")
+                self.logger.info("Found image to process: %s", file_path)
                 self.enqueue_image(file_path)
 
     def start_watchdog(self, directory):
@@ -128,7 +261,7 @@ class MainRunner:
         observer = Observer()
         observer.schedule(event_handler, directory, recursive=False)
         observer.start()
-        self.logger.info(f"Started watchdog observer on directory: {directory}")
+        self.logger.info("Started watchdog observer on directory: %s", directory)
         try:
             while True:
                 time.sleep(1)
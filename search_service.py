@@ -0,0 +1,263 @@
+# search_service.py
+
+import argparse
+import http.client
+import io
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+from config import Config
+
+
+class MicroBatcher:
+    """Merges concurrent search requests against one gallery into single index queries.
+
+    Requests wait at most SEARCH_BATCH_WAIT_SECONDS for others to join, and a batch
+    never grows past SEARCH_BATCH_MAX_QUERIES embeddings.
+    """
+
+    def __init__(self, gallery, max_queries=None, max_wait=None):
+        self.gallery = gallery
+        self.max_queries = max_queries or Config.SEARCH_BATCH_MAX_QUERIES
+        self.max_wait = Config.SEARCH_BATCH_WAIT_SECONDS if max_wait is None else max_wait
+        self.pending = []
+        self.condition = threading.Condition()
+        self.batches = 0
+        self.queries = 0
+        threading.Thread(target=self.run, daemon=True, name=f"{gallery.label.lower()}-search-batcher").start()
+
+    def submit(self, queries, k):
+        future = Future()
+        with self.condition:
+            self.pending.append((queries, k, future))
+            self.condition.notify()
+        return future
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                deadline = time.perf_counter() + self.max_wait
+                while sum(len(q) for q, _, _ in self.pending) < self.max_queries:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch, size = [], 0
+                while self.pending and (not batch or size + len(self.pending[0][0]) <= self.max_queries):
+                    batch.append(self.pending.pop(0))
+                    size += len(batch[-1][0])
+            self.execute(batch)
+
+    def execute(self, batch):
+        try:
+            queries = np.vstack([q for q, _, _ in batch])
+            k = max(k for _, k, _ in batch)
+            # Search one snapshot so the reported version is the one the results come from
+            snapshot = self.gallery.snapshot
+            self.gallery.searches += 1
+            # Fetch extra rows so people with several templates still yield k distinct ids
+            similarities, person_ids = snapshot.search(queries, k * Config.MAX_TEMPLATES_PER_PERSON)
+            self.batches += 1
+            self.queries += len(queries)
+            start = 0
+            for q, k, future in batch:
+                rows = range(start, start + len(q))
+                future.set_result((snapshot.version, [top_k_people(person_ids[i], similarities[i], k) for i in rows]))
+                start += len(q)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+
+def top_k_people(person_ids, similarities, k):
+    """Collapse template hits (sorted best first) into the k best distinct people."""
+    results, seen = [], set()
+    for person_id, similarity in zip(person_ids, similarities):
+        person_id = int(person_id)
+        if person_id == -1 or person_id in seen:
+            continue
+        seen.add(person_id)
+        results.append({'person_id': person_id, 'score': float(similarity)})
+        if len(results) == k:
+            break
+    return results
+
+
+class JsonRequestHandler(BaseHTTPRequestHandler):
+    """Keep-alive HTTP handler answering in JSON, over TCP or a Unix socket."""
+
+    protocol_version = 'HTTP/1.1'
+    log_name = 'HTTP'  # Prefix of the access log lines
+
+    def send_json(self, status, payload, close=False):
+        """Send a JSON response; close=True when the request body was left unread, so it is never parsed as the next request."""
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if close:
+            self.close_connection = True
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket peers have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        Config.logger.debug(self.log_name + ": " + format, *args)
+
+
+class SearchRequestHandler(JsonRequestHandler):
+    """POST /search?gallery=client&k=5 with a JSON {"embeddings": [[...], ...]} or .npy body; GET /version."""
+
+    log_name = 'Search service'
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/version':
+            return self.send_json(404, {'error': 'Not found'})
+        self.send_json(200, {name: gallery.metrics() for name, gallery in self.server.galleries.items()})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/search':
+            return self.send_json(404, {'error': 'Not found'})
+        try:
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.headers.get('Content-Type') == 'application/x-npy':
+                embeddings = np.load(io.BytesIO(body), allow_pickle=False)
+            else:
+                payload = json.loads(body)
+                params.update({key: payload[key] for key in ('gallery', 'k') if key in payload})
+                embeddings = payload['embeddings']
+            queries = np.ascontiguousarray(np.asarray(embeddings, dtype='float32').reshape(-1, Config.DIMENSIONS))
+            gallery = params.get('gallery', 'client')
+            k = int(params.get('k', Config.SEARCH_DEFAULT_K))
+            if gallery not in self.server.batchers:
+                return self.send_json(400, {'error': f"Unknown gallery: {gallery}"})
+            if k <= 0:
+                return self.send_json(400, {'error': f"k must be positive, got {k}"})
+        except Exception as e:
+            return self.send_json(400, {'error': f"Invalid request: {e}"})
+
+        try:
+            version, results = self.server.batchers[gallery].submit(queries, k).result()
+        except Exception as e:
+            Config.logger.error("Error in gallery search service: %s", e)
+            return self.send_json(500, {'error': str(e)})
+        self.send_json(200, {'gallery': gallery, 'version': version, 'results': results})
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+
+
+def start_search_service(galleries):
+    """Serve {'employee': Gallery, 'client': Gallery} on SEARCH_SERVICE_SOCKET, or SEARCH_SERVICE_HOST:PORT if unset."""
+    if Config.SEARCH_SERVICE_SOCKET:
+        server = UnixHTTPServer(Config.SEARCH_SERVICE_SOCKET, SearchRequestHandler)
+        address = Config.SEARCH_SERVICE_SOCKET
+    else:
+        server = ThreadingHTTPServer((Config.SEARCH_SERVICE_HOST, Config.SEARCH_SERVICE_PORT), SearchRequestHandler)
+        address = f"http://{Config.SEARCH_SERVICE_HOST}:{server.server_address[1]}"
+    server.galleries = galleries
+    server.batchers = {name: MicroBatcher(gallery) for name, gallery in galleries.items()}
+    threading.Thread(target=server.serve_forever, daemon=True, name="search-service").start()
+    Config.logger.info("Gallery search service listening on %s", address)
+    return server
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=30):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def search_gallery(embeddings, gallery='client', k=None, connection=None):
+    """Query a running search service. Returns (version, [[{'person_id', 'score'}, ...] per embedding])."""
+    if connection is None:
+        if Config.SEARCH_SERVICE_SOCKET:
+            connection = UnixHTTPConnection(Config.SEARCH_SERVICE_SOCKET)
+        else:
+            connection = http.client.HTTPConnection(Config.SEARCH_SERVICE_HOST, Config.SEARCH_SERVICE_PORT, timeout=30)
+    buffer = io.BytesIO()
+    np.save(buffer, np.asarray(embeddings, dtype='float32'))
+    connection.request(
+        'POST', f"/search?gallery={gallery}&k={k or Config.SEARCH_DEFAULT_K}",
+        body=buffer.getvalue(), headers={'Content-Type': 'application/x-npy'}
+    )
+    response = connection.getresponse()
+    payload = json.loads(response.read())
+    if response.status != 200:
+        raise RuntimeError(f"Search service returned {response.status}: {payload.get('error')}")
+    return payload['version'], payload['results']
+
+
+def benchmark(gallery_size, clients, requests_per_client, queries_per_request, k):
+    """Measure service throughput on a synthetic gallery, with and without micro-batching."""
+    from gallery import Gallery
+
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((gallery_size, Config.DIMENSIONS)).astype('float32')
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    gallery = Gallery("Client", Config.DIMENSIONS)
+    gallery.reset({i: vectors[i:i + 1] for i in range(gallery_size)})
+
+    Config.SEARCH_SERVICE_PORT = 0  # Any free port
+    Config.SEARCH_SERVICE_SOCKET = ''
+    for label, max_queries in (('unbatched', 1), ('micro-batched', Config.SEARCH_BATCH_MAX_QUERIES)):
+        server = start_search_service({'client': gallery})
+        server.batchers['client'] = MicroBatcher(gallery, max_queries=max_queries, max_wait=0 if max_queries == 1 else None)
+        port = server.server_address[1]
+
+        def client_loop(_):
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+            for _ in range(requests_per_client):
+                queries = vectors[rng.integers(0, gallery_size, queries_per_request)]
+                search_gallery(queries, 'client', k, connection)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            list(executor.map(client_loop, range(clients)))
+        elapsed = time.perf_counter() - started
+        batcher = server.batchers['client']
+        total = clients * requests_per_client * queries_per_request
+        print(
+            f"{label:>14}: {total / elapsed:10.1f} queries/s, {clients * requests_per_client / elapsed:8.1f} requests/s, "
+            f"{batcher.queries / max(batcher.batches, 1):.1f} queries per index search"
+        )
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the gallery search service on a synthetic gallery.")
+    parser.add_argument('--gallery-size', type=int, default=100000)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=50, help="Requests per client")
+    parser.add_argument('--queries', type=int, default=1, help="Embeddings per request")
+    parser.add_argument('--k', type=int, default=5)
+    args = parser.parse_args()
+    benchmark(args.gallery_size, args.clients, args.requests, args.queries, args.k)
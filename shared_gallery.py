@@ -0,0 +1,291 @@
+# shared_gallery.py
+
+import json
+import os
+import threading
+import time
+import numpy as np
+import faiss
+from pymongo import MongoClient
+from config import Config
+from database_manager import DatabaseManager
+from gallery import GallerySnapshot, SegmentState
+
+# How long a worker keeps matching a client it created before the shared gallery shows it
+PENDING_CLIENT_TTL_SECONDS = 300
+
+
+class SharedGalleryPublisher:
+    """Owner-side writer that mirrors each gallery snapshot into files under a shared-memory directory.
+
+    Every segment is written once, as <label>_s<segment>.index (the full faiss index) and .ids.npy;
+    segments never change, so a publish only writes the new ones plus the dead rows of segments that
+    gained some. A <label>.json manifest listing the segments of the latest version is swapped in
+    atomically and a shared version counter per gallery tells workers when to reload it. Workers map
+    the files read-only, so they share the same page-cache pages and no worker holds its own copy of
+    the gallery. Files no longer listed are unlinked right away; workers that still map them keep a
+    valid mapping until they move on.
+    """
+
+    def __init__(self, galleries, directory, context):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        labels = tuple(gallery.label.lower() for gallery in galleries)
+        for name in os.listdir(directory):
+            # Segment ids restart with the process; never let a worker map a previous run's files
+            if name.startswith(labels):
+                os.remove(os.path.join(directory, name))
+        self.versions = {gallery.label: context.Value('q', -1, lock=False) for gallery in galleries}
+        self.latest = {}
+        self.written = {}  # label -> (version, files the manifest of that version lists)
+        self.published = threading.Event()
+        for gallery in galleries:
+            self.latest[gallery.label] = gallery.snapshot
+            gallery.listeners.append(self.on_publish)
+        self.published.set()
+        threading.Thread(target=self.run, daemon=True, name="shared-gallery-publisher").start()
+
+    def on_publish(self, gallery, snapshot):
+        self.latest[gallery.label] = snapshot
+        self.published.set()
+
+    def run(self):
+        while True:
+            self.published.wait()
+            self.published.clear()
+            for label, snapshot in list(self.latest.items()):
+                if self.written.get(label, (None,))[0] == snapshot.version:
+                    continue
+                try:
+                    self.write(label, snapshot)
+                except Exception as e:
+                    Config.logger.error("Error writing shared %s gallery v%s: %s", label, snapshot.version, e)
+            # Coalesce bursts of snapshots into one file write per interval
+            time.sleep(Config.SHARED_GALLERY_MIN_INTERVAL_SECONDS)
+
+    def write(self, label, snapshot):
+        started = time.perf_counter()
+        stem = os.path.join(self.directory, label.lower())
+        previous = self.written.get(label, (None, set()))[1]
+        files, segments = set(), []
+        for state in snapshot.states:
+            segment = state.segment
+            entry = {'id': segment.id, 'index': f"{stem}_s{segment.id}.index", 'ids': f"{stem}_s{segment.id}.ids.npy"}
+            if entry['ids'] not in previous:
+                faiss.write_index(segment.index, entry['index'])
+                np.save(entry['ids'], segment.ids)
+            if len(state.dead):
+                # A segment's dead rows only grow, so their count names each version of them
+                entry['dead'] = f"{stem}_s{segment.id}_d{len(state.dead)}.dead.npy"
+                if entry['dead'] not in previous:
+                    np.save(entry['dead'], state.dead)
+            files.update(path for key, path in entry.items() if key != 'id')
+            segments.append(entry)
+
+        manifest = os.path.join(self.directory, f"{label.lower()}.json")
+        with open(f"{manifest}.tmp", 'w') as f:
+            json.dump({'version': snapshot.version, 'people': snapshot.people, 'segments': segments}, f)
+        os.replace(f"{manifest}.tmp", manifest)
+        self.versions[label].value = snapshot.version
+
+        self.written[label] = (snapshot.version, files)
+        for path in previous - files:
+            if os.path.exists(path):
+                os.remove(path)
+        Config.logger.debug(
+            "Shared %s gallery v%s (%s templates in %s segments) in %.1f ms",
+            label, snapshot.version, len(snapshot), len(segments), (time.perf_counter() - started) * 1000
+        )
+
+
+class MappedSegment:
+    """A published gallery segment mapped read-only from the shared directory, in place of a GallerySegment."""
+
+    def __init__(self, entry):
+        self.id = entry['id']
+        self.index = faiss.read_index(entry['index'], faiss.IO_FLAG_MMAP_IFC)
+        self.ids = np.load(entry['ids'], mmap_mode='r')
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class SharedGalleryReader:
+    """Worker-side read-only view of a gallery published by SharedGalleryPublisher.
+
+    Each segment's faiss index is memory-mapped and searched in place with its own codec, exactly
+    as the owner searches it, so compressed galleries are never decoded. Segments are immutable,
+    so a new version only maps the segments this worker has not seen yet.
+    """
+
+    def __init__(self, label, directory, version):
+        self.label = label
+        self.manifest = os.path.join(directory, f"{label.lower()}.json")
+        self.version = version
+        self.loaded_version = None
+        self.states = {}  # (segment id, dead rows) -> SegmentState of the loaded version
+        self.snapshot = GallerySnapshot([], None, -1, 0)
+
+    def refresh(self):
+        if self.version.value < 0 or self.version.value == self.loaded_version:
+            return
+        for _ in range(3):
+            try:
+                with open(self.manifest) as f:
+                    manifest = json.load(f)
+                # Map the new segments before dropping the old ones so searches never see a half-swap
+                segments = {state.segment.id: state.segment for state in self.states.values()}
+                states = {}
+                for entry in manifest['segments']:
+                    key = (entry['id'], entry.get('dead'))
+                    state = self.states.get(key)
+                    if state is None:
+                        segment = segments.get(entry['id']) or MappedSegment(entry)
+                        state = SegmentState(segment, np.load(entry['dead']) if 'dead' in entry else None)
+                    states[key] = state
+            except (OSError, ValueError, RuntimeError):
+                # The owner replaced this version while we were opening it; read the manifest again
+                continue
+            self.states = states
+            self.snapshot = GallerySnapshot(list(states.values()), None, manifest['version'], manifest['people'])
+            self.loaded_version = manifest['version']
+            Config.logger.debug(
+                "Mapped shared %s gallery v%s (%s templates in %s segments)", self.label, self.loaded_version, len(self.snapshot), len(states)
+            )
+            return
+        Config.logger.warning("Shared %s gallery is not available yet.", self.label)
+
+    def search(self, queries, k):
+        """Return (similarities, person_ids) of the k best rows per query, like GallerySnapshot.search."""
+        self.refresh()
+        return self.snapshot.search(queries, k)
+
+    def contains(self, person_id):
+        """True if the loaded version holds a live row of the person."""
+        for state in self.snapshot.states:
+            rows = np.flatnonzero(state.segment.ids == person_id)
+            if len(np.setdiff1d(rows, state.dead, assume_unique=True)):
+                return True
+        return False
+
+
+class SharedDatabaseClient(DatabaseManager):
+    """DatabaseManager stand-in for worker processes.
+
+    Matching reads the shared galleries; the writes process_image makes are forwarded to
+    the owner process, which applies them and publishes the next version.
+
+    A client this worker creates only reaches the shared gallery a publish later, so it is
+    also kept in a worker-local pending list that client matching searches until the gallery
+    shows it; otherwise the same person seen again meanwhile would be created twice. Clients
+    created by other workers in that window still can be, and the compaction job merges them.
+    """
+
+    FORWARDED_METHODS = ('add_client_embedding', 'add_employee_template', 'add_client_template')
+
+    def __init__(self, directory, versions, write_queue):
+        self.mongo_client = MongoClient(os.getenv('MONGODB_LOCAL'))
+        self.mongo_db = self.mongo_client.empl_time_fastapi
+        self.employees_collection = self.mongo_db.employees
+        self.clients_collection = self.mongo_db.clients
+
+        self.DIMENSIONS = Config.DIMENSIONS
+        self.employee_gallery = SharedGalleryReader("Employee", directory, versions["Employee"])
+        self.client_gallery = SharedGalleryReader("Client", directory, versions["Client"])
+        self.write_queue = write_queue
+        self.pending_clients = {}  # person_id -> (normalized embedding, time added), not yet in the shared gallery
+        self.pending_checked_version = None
+
+    def add_client_embedding(self, person_id, embedding, image=None):
+        embedding = np.asarray(embedding, dtype='float32')
+        self.write_queue.put(('add_client_embedding', (person_id, embedding)))
+        norm = np.linalg.norm(embedding)
+        if norm > 0:
+            self.pending_clients[person_id] = (embedding / norm, time.monotonic())
+
+    def find_matching_clients(self, embeddings):
+        """Match against the shared client gallery, then against clients this worker created that it does not show yet."""
+        results = super().find_matching_clients(embeddings)
+        pending = self.unpublished_clients()
+        if not pending or not results:
+            return results
+        person_ids = list(pending)
+        similarities = np.asarray(embeddings, dtype='float32').reshape(-1, self.DIMENSIONS) @ np.vstack(list(pending.values())).T
+        for i, row in enumerate(similarities):
+            best = int(np.argmax(row))
+            if row[best] > Config.CHECK_NEW_CLIENT and row[best] > results[i][1]:
+                # The document is not in MongoDB yet either; reporting a visit only needs the id
+                results[i] = ({'person_id': person_ids[best]}, float(row[best]))
+        return results
+
+    def unpublished_clients(self):
+        """Return {person_id: embedding} of pending clients, dropping those the shared gallery now holds."""
+        if not self.pending_clients:
+            return {}
+        gallery = self.client_gallery
+        gallery.refresh()
+        now = time.monotonic()
+        if gallery.loaded_version != self.pending_checked_version:
+            self.pending_checked_version = gallery.loaded_version
+            for person_id in [pid for pid in self.pending_clients if gallery.contains(pid)]:
+                del self.pending_clients[person_id]
+        for person_id in [pid for pid, (_, added) in self.pending_clients.items() if now - added > PENDING_CLIENT_TTL_SECONDS]:
+            # The owner failed to apply it; stop matching a client the gallery will never show
+            del self.pending_clients[person_id]
+        return {pid: embedding for pid, (embedding, _) in self.pending_clients.items()}
+
+    def add_employee_template(self, person_id, embedding):
+        self.write_queue.put(('add_employee_template', (person_id, np.asarray(embedding, dtype='float32'))))
+
+    def add_client_template(self, person_id, embedding):
+        self.write_queue.put(('add_client_template', (person_id, np.asarray(embedding, dtype='float32'))))
+
+
+def apply_worker_writes(db_manager, write_queue):
+    """Owner-side loop applying the writes forwarded by SharedDatabaseClient."""
+    while True:
+        method, args = write_queue.get()
+        if method not in SharedDatabaseClient.FORWARDED_METHODS:
+            Config.logger.warning("Ignoring unknown forwarded write: %s", method)
+            continue
+        try:
+            getattr(db_manager, method)(*args)
+        except Exception as e:
+            Config.logger.error("Error applying forwarded %s: %s", method, e)
+
+
+def run_worker_process(directory, versions, image_queue, write_queue, employee_last_report_times, client_last_report_times, lock, workers_ready):
+    """Entry point of an inference worker process; counts itself in workers_ready once it can process frames."""
+    from face_processor import FaceProcessor
+    from image_handler import process_image, process_frame, Frame
+    from tracing import trace_frame
+
+    db_manager = SharedDatabaseClient(directory, versions, write_queue)
+    face_processor = FaceProcessor()
+    db_manager.employee_gallery.refresh()
+    db_manager.client_gallery.refresh()
+    with workers_ready.get_lock():
+        workers_ready.value += 1
+    Config.logger.info("Worker process %s ready.", os.getpid())
+    while True:
+        item = image_queue.get()
+        if item is None:
+            # Sentinel value to stop the worker
+            break
+        try:
+            with trace_frame(item.filename if isinstance(item, Frame) else item):
+                if isinstance(item, Frame):
+                    process_frame(item, db_manager, face_processor, employee_last_report_times, client_last_report_times, lock)
+                    continue
+                Config.logger.info("Worker process %s processing image: %s", os.getpid(), item)
+                process_image(
+                    item,
+                    1,  # camera_id
+                    db_manager,
+                    face_processor,
+                    employee_last_report_times,
+                    client_last_report_times,
+                    lock
+                )
+        except Exception as e:
+            Config.logger.error("Error in worker process %s: %s", os.getpid(), e)
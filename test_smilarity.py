@@ -1,30 +1,11 @@
 # test_similarity.py
 
 import cv2
-import numpy as np
 from face_processor import FaceProcessor
 from config import Config, setup_logger
+from funcs import compute_sim
 import logging
 
-# Define the compute_sim function
-def compute_sim(feat1, feat2, logger=Config.logger):
-    try:
-        feat1 = feat1.ravel()
-        feat2 = feat2.ravel()
-        # Normalize embeddings
-        feat1_norm = np.linalg.norm(feat1)
-        feat2_norm = np.linalg.norm(feat2)
-        if feat1_norm == 0 or feat2_norm == 0:
-            logger.error("One of the embeddings has zero norm.")
-            return None
-        feat1 = feat1 / feat1_norm
-        feat2 = feat2 / feat2_norm
-        sim = np.dot(feat1, feat2)
-        return sim
-    except Exception as e:
-        logger.error(e)
-        return None
-
 def compute_similarity_between_images(image_path1, image_path2):
     # Initialize FaceProcessor
     face_processor = FaceProcessor()
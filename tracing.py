@@ -0,0 +1,198 @@
+# tracing.py
+
+import atexit
+import cProfile
+import json
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from config import Config, DeferredQueueHandler
+
+_local = threading.local()
+_null_span = nullcontext()
+_marks = {}  # source -> {'detected': wall time, 'enqueued': wall time}
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def enabled():
+    return Config.TRACE_SAMPLE_RATE > 0
+
+
+def mark(source, event):
+    """Remember when a frame was first detected or queued, so its trace can show debounce and queue wait."""
+    if not enabled():
+        return
+    if len(_marks) > 10000:
+        # Frames consumed in worker processes never collect their marks here
+        _marks.clear()
+    _marks.setdefault(source, {}).setdefault(event, time.time())
+
+
+def span(name, **attributes):
+    """Time a block as part of the current frame's trace; a no-op when the frame is not traced."""
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return _null_span
+    return trace.span(name, attributes)
+
+
+def annotate(**attributes):
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        trace.attributes.update(attributes)
+
+
+def attach_input(jpeg_bytes):
+    """Keep a reference to the frame's JPEG so it can be saved if the frame turns out slow."""
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        trace.jpeg_bytes = jpeg_bytes
+
+
+class FrameTrace:
+    def __init__(self, source, profile):
+        self.source = source
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.spans = []
+        self.attributes = {}
+        self.jpeg_bytes = None
+        self.profiler = cProfile.Profile() if profile else None
+
+    @contextmanager
+    def span(self, name, attributes):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            record = {
+                'name': name,
+                'start_ms': round((started - self.started) * 1000, 3),
+                'duration_ms': round((time.perf_counter() - started) * 1000, 3),
+            }
+            if attributes:
+                record.update(attributes)
+            self.spans.append(record)
+
+    def add_marks(self, marks):
+        """Turn detection and queueing times into spans that start before the trace itself."""
+        detected, enqueued = marks.get('detected'), marks.get('enqueued')
+        if detected and enqueued:
+            self.spans.append({
+                'name': 'debounce',
+                'start_ms': round((detected - self.started_at) * 1000, 3),
+                'duration_ms': round((enqueued - detected) * 1000, 3),
+            })
+        if enqueued:
+            self.spans.append({
+                'name': 'queue_wait',
+                'start_ms': round((enqueued - self.started_at) * 1000, 3),
+                'duration_ms': round((self.started_at - enqueued) * 1000, 3),
+            })
+
+    def record(self, total_seconds):
+        return {
+            'source': self.source,
+            'started_at': datetime.fromtimestamp(self.started_at).isoformat(),
+            'pid': os.getpid(),
+            'total_ms': round(total_seconds * 1000, 3),
+            **self.attributes,
+            'spans': self.spans,
+        }
+
+
+@contextmanager
+def trace_frame(source):
+    """Trace one frame from dequeue to the last report, for a TRACE_SAMPLE_RATE share of frames."""
+    if not enabled():
+        yield None
+        return
+    marks = _marks.pop(source, {})
+    if random.random() >= Config.TRACE_SAMPLE_RATE:
+        yield None
+        return
+
+    trace = FrameTrace(source, random.random() < Config.TRACE_PROFILE_RATE)
+    trace.add_marks(marks)
+    _local.trace = trace
+    if trace.profiler:
+        try:
+            trace.profiler.enable()
+        except ValueError:
+            # Another thread is already profiling
+            trace.profiler = None
+    try:
+        yield trace
+    finally:
+        if trace.profiler:
+            trace.profiler.disable()
+        _local.trace = None
+        total = time.perf_counter() - trace.started
+        record = trace.record(total)
+        if total >= Config.TRACE_SLOW_FRAME_SECONDS:
+            record.update(save_slow_frame(trace, total))
+        write_trace(record)
+
+
+def save_slow_frame(trace, total_seconds):
+    """Keep the input image and the profile of a frame over the latency threshold."""
+    saved = {'slow': True}
+    try:
+        os.makedirs(Config.TRACE_SLOW_FRAME_DIR, exist_ok=True)
+        stem = os.path.join(
+            Config.TRACE_SLOW_FRAME_DIR,
+            f"{datetime.fromtimestamp(trace.started_at).strftime('%Y%m%d%H%M%S%f')}_{os.path.splitext(os.path.basename(trace.source))[0]}"
+        )
+        if trace.jpeg_bytes is not None:
+            with open(f"{stem}.jpg", 'wb') as f:
+                f.write(trace.jpeg_bytes)
+            saved['image'] = f"{stem}.jpg"
+        if trace.profiler:
+            trace.profiler.dump_stats(f"{stem}.prof")
+            saved['profile'] = f"{stem}.prof"
+        Config.logger.warning("Slow frame %s took %.0f ms; saved to %s.*", trace.source, total_seconds * 1000, stem)
+    except Exception as e:
+        Config.logger.error("Error saving slow frame %s: %s", trace.source, e)
+    return saved
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps(record.msg, default=str)
+
+
+def write_trace(record):
+    """Append a trace record to the rotating JSONL file; encoding and I/O run on a listener thread."""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                path = Config.TRACE_FILE
+                if multiprocessing.parent_process() is not None:
+                    # One file per worker process so rotation never races
+                    root, ext = os.path.splitext(path)
+                    path = f"{root}.{os.getpid()}{ext}"
+                os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                handler = logging.handlers.RotatingFileHandler(
+                    path, maxBytes=Config.TRACE_FILE_MAX_BYTES, backupCount=Config.TRACE_FILE_BACKUPS
+                )
+                handler.setFormatter(JsonFormatter())
+                trace_queue = queue.SimpleQueue()
+                listener = logging.handlers.QueueListener(trace_queue, handler)
+                listener.start()
+                atexit.register(listener.stop)
+
+                writer = logging.getLogger('FrameTrace')
+                writer.setLevel(logging.INFO)
+                writer.propagate = False
+                writer.addHandler(DeferredQueueHandler(trace_queue))
+                _writer = writer
+    _writer.info(record)
@@ -3,65 +3,126 @@
 import asyncio
 import websockets
 import json
+from concurrent.futures import ThreadPoolExecutor
 from config import Config
+from data_fetcher import fetch_and_store_data
 from funcs import get_embedding_from_url
 
 async def websocket_listener(db_manager, face_processor):
     uri = f"{Config.API_BASE_URL.replace('http', 'ws')}/ws"
+    executor = ThreadPoolExecutor(max_workers=Config.WS_MAX_CONCURRENCY, thread_name_prefix='ws-update')
+    dispatcher = UpdateDispatcher(db_manager, face_processor, executor)
+    backoff = Config.WS_RECONNECT_MIN_SECONDS
+    connected_before = False
 
-    async with websockets.connect(uri) as websocket:
-        Config.logger.info("Connected to WebSocket server.")
-        while True:
-            try:
-                message = await websocket.recv()
-                data = json.loads(message)
-                Config.logger.info(f"Received data via WebSocket: {data}")
-
-                # Handle the data (e.g., 'employee_update' or 'client_update')
-                if data['event'] == 'employee_update':
-                    await handle_employee_update(data['data'], db_manager, face_processor)
-                elif data['event'] == 'employee_delete':
-                    await handle_employee_removed(data['data']['id'], db_manager)
-                elif data['event'] == 'client_delete':
-                    await handle_client_removed(data['data']['id'], db_manager)
-                else:
-                    Config.logger.warning(f"Unknown data type received: {data['event']}")
-
-            except websockets.ConnectionClosed:
-                Config.logger.error("WebSocket connection closed. Reconnecting...")
-                await asyncio.sleep(5)  # Wait before reconnecting
-                return await websocket_listener(db_manager, face_processor)
-            except Exception as e:
-                Config.logger.error(f"Error in WebSocket listener: {e}")
-                await asyncio.sleep(1)
-
-async def handle_employee_update(employee_data, db_manager, face_processor):
+    while True:
+        try:
+            async with websockets.connect(uri) as websocket:
+                Config.logger.info("Connected to WebSocket server.")
+                backoff = Config.WS_RECONNECT_MIN_SECONDS
+                if connected_before:
+                    # Pick up whatever changed on the backend while we were disconnected
+                    asyncio.get_running_loop().run_in_executor(
+                        executor, lambda: fetch_and_store_data(db_manager, face_processor, incremental=True)
+                    )
+                connected_before = True
+
+                async for message in websocket:
+                    try:
+                        data = json.loads(message)
+                        Config.logger.info(f"Received data via WebSocket: {data.get('event')}")
+                        dispatcher.submit(data)
+                    except Exception as e:
+                        Config.logger.error(f"Error in WebSocket listener: {e}")
+
+            Config.logger.error("WebSocket connection closed. Reconnecting...")
+        except websockets.ConnectionClosed:
+            Config.logger.error("WebSocket connection closed. Reconnecting...")
+        except Exception as e:
+            Config.logger.error(f"WebSocket connection failed: {e}. Reconnecting in {backoff} seconds...")
+
+        await asyncio.sleep(backoff)  # Wait before reconnecting
+        backoff = min(backoff * 2, Config.WS_RECONNECT_MAX_SECONDS)
+
+class UpdateDispatcher:
+    """Runs WebSocket events on an executor, keeping only the latest pending event per person.
+
+    Download, embedding and Mongo writes never run on the event loop, at most
+    WS_MAX_CONCURRENCY events are processed at once, and a burst of updates for the
+    same person collapses into a single run with the newest data.
+    """
+
+    def __init__(self, db_manager, face_processor, executor):
+        self.db_manager = db_manager
+        self.face_processor = face_processor
+        self.executor = executor
+        self.pending = {}
+        self.in_flight = set()
+
+    def submit(self, data):
+        event = data['event']
+        if event not in EVENT_HANDLERS:
+            Config.logger.warning(f"Unknown data type received: {event}")
+            return
+        kind = event.split('_')[0]
+        key = (kind, data['data']['id'])
+        if key in self.pending:
+            Config.logger.debug(f"Coalescing {event} for ID: {key[1]}")
+        self.pending[key] = data
+        if key not in self.in_flight:
+            self.in_flight.add(key)
+            asyncio.get_running_loop().create_task(self.drain(key))
+
+    async def drain(self, key):
+        loop = asyncio.get_running_loop()
+        try:
+            # Updates that arrive while one is running are picked up on the next pass
+            while key in self.pending:
+                data = self.pending.pop(key)
+                handler = EVENT_HANDLERS[data['event']]
+                try:
+                    await loop.run_in_executor(
+                        self.executor, handler, data['data'], self.db_manager, self.face_processor
+                    )
+                except Exception as e:
+                    Config.logger.error(f"Error handling {data['event']} for ID {key[1]}: {e}")
+        finally:
+            self.in_flight.discard(key)
+
+def handle_employee_update(employee_data, db_manager, face_processor):
     person_id = employee_data['id']
     image_url = f"{Config.API_BASE_URL}/{employee_data['image']}"
     embedding = get_embedding_from_url(image_url, face_processor)
     if embedding is not None:
-        db_manager.add_employee_embedding(person_id, embedding)
+        db_manager.add_employee_embedding(person_id, embedding, image=employee_data['image'])
         Config.logger.info(f"Updated embedding for Employee ID: {person_id}")
     else:
         Config.logger.error(f"Failed to get embedding for Employee ID: {person_id}")
 
-async def handle_client_update(client_data, db_manager, face_processor):
+def handle_client_update(client_data, db_manager, face_processor):
     person_id = client_data['id']
     image_url = f"{Config.API_BASE_URL}/{client_data['image']}"
     embedding = get_embedding_from_url(image_url, face_processor)
     if embedding is not None:
-        db_manager.add_client_embedding(person_id, embedding)
+        db_manager.add_client_embedding(person_id, embedding, image=client_data['image'])
         Config.logger.info(f"Updated embedding for Client ID: {person_id}")
     else:
         Config.logger.error(f"Failed to get embedding for Client ID: {person_id}")
 
-async def handle_employee_removed(employee_id, db_manager):
-    person_id = employee_id
+def handle_employee_removed(employee_data, db_manager, face_processor):
+    person_id = employee_data['id']
     db_manager.remove_employee_embedding(person_id)
     Config.logger.info(f"Removed embedding for Employee ID: {person_id}")
 
 
-async def handle_client_removed(client_id, db_manager):
-    person_id = client_id
+def handle_client_removed(client_data, db_manager, face_processor):
+    person_id = client_data['id']
     db_manager.remove_client_embedding(person_id)
-    Config.logger.info(f"Removed embedding for Client ID: {person_id}")
\ No newline at end of file
+    Config.logger.info(f"Removed embedding for Client ID: {person_id}")
+
+EVENT_HANDLERS = {
+    'employee_update': handle_employee_update,
+    'employee_delete': handle_employee_removed,
+    'client_update': handle_client_update,
+    'client_delete': handle_client_removed,
+}